@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""
+Scrape tiles out of screenshots on disk without Inkscape.
+
+    python batch_scrape.py [options] SCREENSHOTS...
+
+Each argument is a PNG, a directory of them or a glob. The screenshots are
+scraped one at a time, or across a pool of processes with --jobs, and only
+the unique tiles found so far are held in memory. Any of these are written:
+
+* --svg: a document with the screenshots linked on a "Source Layer", each
+  with its tilemap, and the tiles on a "Tileset Layer", ready for the other
+  Tileset Tools effects.
+* --atlas: the tiles packed into a PNG sheet with a JSON map beside it, as
+  Scrape Tiles saves atlases.
+* --tilemap: a JSON file of the tiles and which one covers each cell of
+  every screenshot, packed as in the tti:tilemap attribute.
+
+The document is written as markup as it's scraped, it's never held as a tree.
+With --cache, what each screenshot holds is kept in a directory, and later
+runs only decode the screenshots that are new or have changed since.
+"""
+import glob
+import itertools
+import json
+import logging
+import optparse
+import os
+import shutil
+import tempfile
+import urllib
+
+from xml.sax.saxutils import quoteattr
+
+import inkex
+import tti_cache
+import tti_tools
+
+from PIL import Image
+from tti_datauri import make_data_uri
+
+from scrape_tiles import iter_scraped, tile_image, write_atlas
+
+SVG_HEADER = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<svg xmlns="%(svg)s" xmlns:xlink="%(xlink)s" xmlns:inkscape="%(inkscape)s" \
+xmlns:tti="%(tti)s" width="%%d" height="%%d">
+'''
+
+def find_screenshots(patterns):
+	"""The PNGs named by a list of files, directories and globs, in the order
+	given and each only once."""
+	paths = []
+	for pattern in patterns:
+		if os.path.isdir(pattern):
+			found = sorted(glob.glob(os.path.join(pattern, '*.png')) +
+					glob.glob(os.path.join(pattern, '*.PNG')))
+		elif glob.has_magic(pattern):
+			found = sorted(glob.glob(pattern))
+		else:
+			found = [pattern]
+		paths.extend(found)
+
+	seen = set()
+	unique = []
+	for path in paths:
+		path = os.path.abspath(path)
+		if path not in seen:
+			seen.add(path)
+			unique.append(path)
+	return unique
+
+def path_uri(path):
+	return 'file://' + urllib.pathname2url(path)
+
+class BatchScrape(object):
+	"""Scrape screenshot files into a tileset, writing whichever of an SVG,
+	atlas and tilemap are asked for."""
+
+	def __init__(self, options):
+		self.options = options
+		self.tile_size = options.tile_size
+		self.digests = []
+		self.payloads = {}
+		self.slots = {}
+		self.counts = {}
+		self.sources = []
+
+	def run(self, paths):
+		options = self.options
+		# The Source Layer's markup is spooled to disk as each screenshot is
+		# scraped, the Tileset Layer can only be written once all are.
+		svg_sources = None
+		if options.svg:
+			svg_sources = tempfile.TemporaryFile()
+
+		cache = None
+		if options.cache:
+			cache = tti_cache.TileCache(options.cache, options.cache_size << 20)
+
+		# Only the SVG and the tilemap need each screenshot's tile grid.
+		tilemap = bool(options.svg or options.tilemap)
+		results = iter_scraped([path_uri(path) for path in paths],
+				self.tile_size,
+				stream = options.stream,
+				align = options.align,
+				processes = options.jobs,
+				tilemap = tilemap,
+				symmetric = options.symmetric,
+				cache = cache)
+		top = 0
+		with inkex.profile.phase('scrape'):
+			for path, result in itertools.izip(paths, results):
+				found, grid = result if tilemap else (result, None)
+				source = self.add_source(path, found, grid)
+				if svg_sources is not None:
+					svg_sources.write(self.source_markup(source, top))
+					top += source['height'] + self.tile_size
+				if options.tilemap:
+					self.sources.append(source)
+				logging.info("%s: %d tiles so far" % (path, len(self.digests)))
+		inkex.profile.count('unique_tiles', len(self.digests))
+		if cache is not None:
+			cache.trim()
+
+		outputs = [
+			('svg', options.svg, self.write_svg),
+			('atlas', options.atlas, self.write_atlas),
+			('tilemap', options.tilemap, self.write_tilemap),
+		]
+		for name, path, write in outputs:
+			if not path:
+				continue
+			with inkex.profile.phase(name):
+				if name == 'svg':
+					svg_sources.seek(0)
+					write(path, svg_sources)
+					svg_sources.close()
+				else:
+					write(path)
+			if inkex.profile.enabled and os.path.exists(path):
+				inkex.profile.count('output_bytes', os.path.getsize(path))
+
+	def add_source(self, path, found, grid=None):
+		"""Give the new tiles of a screenshot the next slots and count the
+		cells of its grid, returns the screenshot's tilemap or None without a
+		grid. The tilemap's packed slots and transforms are None if it has
+		tiles past the slots a tilemap can address."""
+		for digest, payload in found:
+			if digest not in self.slots:
+				self.slots[digest] = len(self.digests)
+				self.counts[digest] = 0
+				self.digests.append(digest)
+				self.payloads[digest] = payload
+		if grid is None:
+			return None
+
+		origin, columns, digests, cells, transforms = grid
+		slots = [self.slots[digest] for digest in digests]
+		for i in cells:
+			self.counts[digests[i]] += 1
+
+		width, height = Image.open(path).size
+		source = {
+			'path': path,
+			'width': width,
+			'height': height,
+			'origin': list(origin),
+			'columns': columns,
+			'tilemap': None,
+			'transforms': None,
+		}
+		if slots and max(slots) >= tti_tools.NO_TILE:
+			inkex.errormsg("%s: tilemaps can only address %d tiles" % (path,
+					tti_tools.NO_TILE))
+			return source
+		source['tilemap'] = tti_tools.pack_tilemap([slots[i] for i in cells])
+		if transforms is not None:
+			source['transforms'] = tti_tools.pack_transforms(transforms)
+		return source
+
+	def page_size(self):
+		columns = self.options.columns
+		rows = max(-(-len(self.digests) // columns), 1)
+		return columns * self.tile_size, rows * self.tile_size
+
+	def source_markup(self, source, top):
+		"An <image> linking a screenshot left of the page, with its tilemap."
+		attrs = [
+			('x', -source['width'] - self.tile_size),
+			('y', top),
+			('width', source['width']),
+			('height', source['height']),
+			('xlink:href', path_uri(source['path'])),
+		]
+		if source['tilemap'] is not None:
+			attrs.extend([
+				('tti:tilemap', source['tilemap']),
+				('tti:columns', source['columns']),
+				('tti:origin', '%d,%d' % tuple(source['origin'])),
+				('tti:size', self.tile_size),
+			])
+		if source['transforms'] is not None:
+			attrs.append(('tti:transforms', source['transforms']))
+		return '<image %s/>\n' % ' '.join('%s=%s' % (name, quoteattr(str(value)))
+				for name, value in attrs)
+
+	def tile_markup(self, digest):
+		"A tile for the Tileset Layer, raster or vectorized."
+		tile_size = self.tile_size
+		tile = tti_tools.tile_from_bytes(self.payloads[digest], tile_size)
+		slot = self.slots[digest]
+		x, y = tti_tools.index2pos(self.options.columns, slot, scale=tile_size)
+		tags = 'tti:digest="%s" tti:slot="%d" tti:count="%d"' % (
+				digest, slot, self.counts[digest])
+
+		if self.options.vectorize:
+			any_img = tti_tools.AnyImage(tile_size, (x, y), tile)
+			return '<g %s>%s</g>\n' % (tags,
+					any_img.vectorize_with_paths_markup(merge=True))
+		return '<image x="%d" y="%d" width="%d" height="%d" xlink:href="%s" %s/>\n' % (
+				x, y, tile_size, tile_size,
+				make_data_uri(tile_image(tile, tile_size)), tags)
+
+	def write_svg(self, path, sources):
+		width, height = self.page_size()
+		with open(path, 'w') as f:
+			f.write(SVG_HEADER % inkex.NSS % (width, height))
+			f.write('<g inkscape:label="Source Layer" inkscape:groupmode="layer">\n')
+			shutil.copyfileobj(sources, f)
+			f.write('</g>\n')
+
+			f.write('<g inkscape:label="Tileset Layer" inkscape:groupmode="layer">\n')
+			for digest in self.digests:
+				f.write(self.tile_markup(digest))
+			f.write('</g>\n</svg>\n')
+
+	def write_atlas(self, path):
+		if not self.digests:
+			logging.warning("No tiles to save in an atlas")
+			return
+		images = []
+		rects = []
+		for digest in self.digests:
+			tile = tti_tools.tile_from_bytes(self.payloads[digest], self.tile_size)
+			images.append(tile_image(tile, self.tile_size))
+			rects.append({
+				'digest': digest,
+				'slot': self.slots[digest],
+				'width': self.tile_size,
+				'height': self.tile_size,
+			})
+		options = self.options
+		write_atlas(path, images, rects, self.tile_size,
+				options.atlas_width, options.atlas_padding, options.atlas_extrude)
+
+	def write_tilemap(self, path):
+		tilemap = {
+			'tile_size': self.tile_size,
+			'tiles': [{
+				'digest': digest,
+				'slot': self.slots[digest],
+				'count': self.counts[digest],
+			} for digest in self.digests],
+			'sources': self.sources,
+		}
+		with open(path, 'w') as f:
+			json.dump(tilemap, f, indent = 1, separators = (',', ': '), sort_keys = True)
+
+def main(argv=None):
+	parser = optparse.OptionParser(usage = '%prog [options] SCREENSHOTS...',
+			description = 'Scrape the tiles out of PNG screenshots, given as '
+					'files, directories or globs.')
+
+	parser.add_option('-s', '--size',
+					action = 'store', type = 'int',
+					dest = 'tile_size', default = 12,
+					help = 'What is the size of a tile in pixels?')
+
+	parser.add_option('-n', '--no-align',
+					action = 'store_false',
+					dest = 'align', default = True,
+					help = 'Only scrape screenshots cropped to the tile grid')
+
+	parser.add_option('-y', '--symmetry',
+					action = 'store_true',
+					dest = 'symmetric', default = False,
+					help = 'Treat rotated and mirrored copies of a tile as the same tile')
+
+	parser.add_option('-m', '--stream',
+					action = 'store_true',
+					dest = 'stream', default = False,
+					help = 'Read screenshots a row of tiles at a time')
+
+	parser.add_option('-j', '--jobs',
+					action = 'store', type = 'int',
+					dest = 'jobs', default = 1,
+					help = 'How many processes to scrape with? (0 for one per core)')
+
+	parser.add_option('-u', '--cache',
+					action = 'store', type = 'string',
+					dest = 'cache', default = '',
+					help = 'Keep what each screenshot holds in this directory, to only rescrape changed ones')
+
+	parser.add_option('--cache-size',
+					action = 'store', type = 'int',
+					dest = 'cache_size', default = 256,
+					help = 'How many megabytes the cache can grow to')
+
+	parser.add_option('-o', '--svg',
+					action = 'store', type = 'string',
+					dest = 'svg', default = '',
+					help = 'Write an SVG with the screenshots and a Tileset Layer here')
+
+	parser.add_option('-c', '--columns',
+					action = 'store', type = 'int',
+					dest = 'columns', default = 16,
+					help = 'How many tiles wide is the Tileset Layer?')
+
+	parser.add_option('-v', '--vectorize',
+					action = 'store_true',
+					dest = 'vectorize', default = False,
+					help = 'Vectorize the tiles in the SVG')
+
+	parser.add_option('-x', '--atlas',
+					action = 'store', type = 'string',
+					dest = 'atlas', default = '',
+					help = 'Save the tiles packed into this PNG, with a JSON map beside it')
+
+	parser.add_option('-w', '--atlas-width',
+					action = 'store', type = 'int',
+					dest = 'atlas_width', default = 0,
+					help = 'Width of the atlas (0 for the smallest power of two sheet)')
+
+	parser.add_option('-d', '--atlas-padding',
+					action = 'store', type = 'int',
+					dest = 'atlas_padding', default = 0,
+					help = 'Pixels left clear between tiles in the atlas')
+
+	parser.add_option('-r', '--atlas-extrude',
+					action = 'store', type = 'int',
+					dest = 'atlas_extrude', default = 0,
+					help = 'Pixels each tile\'s edges are repeated outwards in the atlas')
+
+	parser.add_option('-p', '--tilemap',
+					action = 'store', type = 'string',
+					dest = 'tilemap', default = '',
+					help = 'Write the tilemap of every screenshot to this JSON file')
+
+	parser.add_option('--profile',
+					action = 'store', type = 'string',
+					dest = 'profile', default = os.environ.get('INKEX_PROFILE', ''),
+					help = 'Write a JSON report of where the time went to this file, or - for stderr')
+
+	parser.add_option('--verbose',
+					action = 'store_true',
+					dest = 'verbose', default = False,
+					help = 'Log progress')
+
+	options, args = parser.parse_args(argv)
+	if not args:
+		parser.error("No screenshots given")
+	if not (options.svg or options.atlas or options.tilemap):
+		parser.error("Nothing to write, give --svg, --atlas and/or --tilemap")
+	if options.verbose:
+		logging.getLogger().setLevel(logging.INFO)
+
+	paths = find_screenshots(args)
+	if not paths:
+		parser.error("No screenshots found")
+
+	if options.profile:
+		inkex.profile.enable()
+	BatchScrape(options).run(paths)
+	if options.profile:
+		inkex.profile.write(options.profile, effect = 'BatchScrape')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Benchmark of decoding and encoding the data: URIs screenshots are embedded with.
+
+Embeds a noisy screenshot as a PNG data URI and times decoding it into a PIL
+image and encoding it back, with the per-module copies tti_datauri replaced
+and with tti_datauri.  Memory is reported as the peak growth of the process
+while doing one round, measured in a forked child so runs don't share a
+high-water mark, and as a multiple of the PNG's size: the number of
+payload-sized buffers alive at once.
+
+Run from the repository root:  python benchmarks/datauri.py [width height]
+"""
+import os
+import ctypes
+import random
+import sys
+import time
+import urllib
+
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image
+
+import tti_datauri
+
+def legacy_decode_uri(uri):
+	if uri.startswith("file:///"):
+		return urllib.unquote(uri[len("file:///"):])
+	return StringIO(uri[uri.find("base64,") + len("base64,"):].decode('base64'))
+
+def legacy_make_data_uri(img):
+	s = StringIO()
+	img.save(s, 'png')
+	s.seek(0)
+	img_s = ''.join(s.readlines()).encode('base64').translate(None, '\n')
+	return "data:image/png;base64,%s" % img_s
+
+def make_screenshot(width, height, seed=0):
+	"A screenshot that doesn't compress to nothing, so the payload is big."
+	rng = random.Random(seed)
+	noise = ''.join(chr(rng.randrange(256)) for i in xrange((width * height * 3 + 3) // 4))
+	return Image.frombuffer('RGB', (width, height), (noise * 4)[:width * height * 3],
+			'raw', 'RGB', 0, 1)
+
+def proc_status(field):
+	"A memory figure from /proc/self/status, in bytes."
+	for line in open('/proc/self/status'):
+		if line.startswith(field + ':'):
+			return int(line.split()[1]) * 1024
+
+def reset_peak():
+	"Hand freed memory back and restart the high-water mark at the current RSS."
+	try:
+		ctypes.CDLL('libc.so.6').malloc_trim(0)
+	except (OSError, AttributeError):
+		pass
+	with open('/proc/self/clear_refs', 'w') as clear_refs:
+		clear_refs.write('5')
+
+def peak_growth(func, *args):
+	"Peak memory growth in bytes of calling func in a forked child (Linux only)."
+	read, write = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read)
+		reset_peak()
+		before = proc_status('VmRSS')
+		func(*args)
+		os.write(write, str(proc_status('VmHWM') - before))
+		os._exit(0)
+	os.close(write)
+	growth = int(os.read(read, 64))
+	os.close(read)
+	os.waitpid(pid, 0)
+	return growth
+
+def best_of(func, *args):
+	times = []
+	for i in range(5):
+		start = time.time()
+		func(*args)
+		times.append(time.time() - start)
+	return min(times)
+
+def main(width=1920, height=1080):
+	img = make_screenshot(width, height)
+	uri = tti_datauri.make_data_uri(img)
+	png_size = len(tti_datauri.decode_payload(uri))
+	assert uri == legacy_make_data_uri(img)
+	print '%dx%d screenshot, %.1f MB PNG, %.1f MB URI' % (width, height,
+			png_size / 1e6, len(uri) / 1e6)
+
+	decode = lambda decode_uri: Image.open(decode_uri(uri))
+	encode = lambda make_data_uri: make_data_uri(img)
+	runs = [('decode', decode, 'before', legacy_decode_uri),
+			('decode', decode, 'after', tti_datauri.decode_uri),
+			('encode', encode, 'before', legacy_make_data_uri),
+			('encode', encode, 'after', tti_datauri.make_data_uri)]
+	for name, func, variant, codec in runs:
+		growth = peak_growth(func, codec)
+		elapsed = best_of(func, codec)
+		print '%s %-7s %8.1fms %8.1f MB peak %5.1f payloads' % (name, variant,
+				elapsed * 1e3, growth / 1e6, float(growth) / png_size)
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Benchmark of packing rectangles into an atlas sheet with tti_pack.
+
+Packs 10k uniform tiles and 10k mixed size sprites with and without padding
+and extrusion, reporting the time taken, the sheet size and how much of the
+sheet the rectangles cover.
+
+Run from the repository root:  python benchmarks/packing.py [count]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tti_pack
+
+SIDES = (8, 12, 16, 24, 32, 48, 64)
+
+def main(count=10000):
+	rng = random.Random(0)
+	inputs = [
+		('tiles', [(16, 16)] * count),
+		('sprites', [(rng.choice(SIDES), rng.choice(SIDES)) for i in xrange(count)]),
+	]
+	settings = [
+		('power of two', {}),
+		('padding 1, extrude 1', {'padding': 1, 'extrude': 1}),
+		('any size', {'power_of_two': False}),
+		('1024 wide', {'width': 1024, 'power_of_two': False}),
+	]
+	for name, sizes in inputs:
+		area = sum(w * h for w, h in sizes)
+		for setting, params in settings:
+			start = time.time()
+			(width, height), positions = tti_pack.pack(sizes, **params)
+			elapsed = time.time() - start
+			print '%-8s %-21s %6.3fs %5dx%-6d %3.0f%% covered' % (name, setting,
+					elapsed, width, height, 100.0 * area / (width * height))
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
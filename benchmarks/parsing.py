@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the unit, style and color parsing hot path.
+
+Builds a tile layer of 100k pixel rects the way Vectorize Tiles writes them
+and reports the per-call cost of inkex.unittouu, simplestyle.parseStyle and
+simplestyle.parseColor over every rect: as the functions were before they
+were memoized, with the patterns precompiled but uncached, and cached.
+
+Run from the repository root:  python benchmarks/parsing.py [rects]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import inkex
+import simplestyle
+import tti_tools
+
+def legacy_unittouu(string):
+	unit = re.compile('(%s)$' % '|'.join(inkex.uuconv.keys()))
+	param = re.compile(r'(([-+]?[0-9]+(\.[0-9]*)?|[-+]?\.[0-9]+)([eE][-+]?[0-9]+)?)')
+
+	p = param.match(string)
+	u = unit.search(string)
+	if p:
+		retval = float(p.string[p.start():p.end()])
+	else:
+		retval = 0.0
+	if u:
+		try:
+			return retval * inkex.uuconv[u.string[u.start():u.end()]]
+		except KeyError:
+			pass
+	return retval
+
+def legacy_parseStyle(s):
+	if s is None:
+		return {}
+	else:
+		return dict([i.split(":") for i in s.split(";") if len(i)])
+
+def legacy_parseColor(c):
+	tmp = simplestyle.svgcolors.get(c.lower())
+	if tmp is not None:
+		c = tmp
+	elif c.startswith('#') and len(c)==4:
+		c='#'+c[1:2]+c[1:2]+c[2:3]+c[2:3]+c[3:]+c[3:]
+	return (int(c[1:3],16), int(c[3:5],16), int(c[5:],16))
+
+def make_layer(count, tile_size=12, colors=48, seed=0):
+	"""A Tileset Layer of count single pixel rects, as Vectorize Tiles writes them"""
+	rng = random.Random(seed)
+	palette = [(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+			   for i in range(colors)]
+	columns = 40
+	layer = inkex.etree.Element(inkex.addNS('g', 'svg'))
+	for i in xrange(count):
+		tile, pixel = divmod(i, tile_size ** 2)
+		y, x = divmod(pixel, tile_size)
+		any_img = tti_tools.AnyImage(tile_size)
+		any_img.pos = ((tile % columns) * tile_size, (tile // columns) * tile_size)
+		attrs = any_img.rect_attrs(rng.choice(palette), x, y, 1, 1)
+		inkex.etree.SubElement(layer, inkex.addNS('rect', 'svg'), attrs)
+	return layer
+
+def parse_rects(rects, unittouu, parseStyle, parseColor):
+	for rect in rects:
+		unittouu(rect.get('x'))
+		unittouu(rect.get('y'))
+		parseColor(parseStyle(rect.get('style'))['fill'])
+
+def timed(rects, *funcs):
+	start = time.time()
+	parse_rects(rects, *funcs)
+	return time.time() - start
+
+def main(count=100000):
+	rects = list(make_layer(count))
+	variants = [
+		('before', legacy_unittouu, legacy_parseStyle, legacy_parseColor),
+		('compiled', inkex.unittouu.uncached,
+			lambda s: dict(simplestyle._parseStyle.uncached(s)),
+			simplestyle.parseColor.uncached),
+		('cached', inkex.unittouu, simplestyle.parseStyle, simplestyle.parseColor),
+	]
+	print '%d rects, 2 unittouu + parseStyle + parseColor per rect' % len(rects)
+	baseline = None
+	for name, unittouu, parseStyle, parseColor in variants:
+		elapsed = min(timed(rects, unittouu, parseStyle, parseColor) for i in range(3))
+		baseline = baseline or elapsed
+		print '%-10s %8.3fs %8.2fus/rect %6.1fx' % (name, elapsed,
+				elapsed / len(rects) * 1e6, baseline / elapsed)
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Benchmark suite of the scrape and vectorize pipeline on a synthetic screenshot.
+
+Each stage is timed on its own, best of a few runs, along with the peak memory
+it grows the process by (Linux only):
+
+  decode             the screenshot's data: URI into a PIL image
+  dedup              get_unique_tiles, with NumPy if it's installed
+  dedup_pure         get_unique_tiles without NumPy
+  vectorize          AnyImage.vectorize_with_paths of every unique tile
+  vectorize_markup   AnyImage.vectorize_with_paths_markup of every unique tile
+  encode             make_data_uri of every unique tile
+  serialize          writing the vectorized Tileset Layer through Fragments
+
+Results can be saved as JSON with --output, and --compare checks them against
+a saved run, exiting with status 1 if any stage got slower or hungrier than
+--threshold allows.
+
+Run from the repository root:  python benchmarks/suite.py [options]
+"""
+import json
+import optparse
+import os
+import platform
+import resource
+import sys
+import time
+
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image
+
+import inkex
+import scrape_tiles
+import tti_datauri
+import tti_tools
+
+from datauri import proc_status, reset_peak
+from synthetic import make_screenshot
+
+# Memory differences smaller than this are noise, whatever the ratio.
+MIN_MEMORY_DELTA = 1 << 20
+
+def unique_tiles(img, tile_size):
+	return sorted(scrape_tiles.get_unique_tiles(img, tile_size))
+
+def tile_positions(tiles, tile_size, columns=16):
+	return [tti_tools.index2pos(columns, i, scale=tile_size) for i in range(len(tiles))]
+
+def stage_decode(ctx):
+	img = Image.open(tti_datauri.decode_uri(ctx['uri']))
+	img.load()
+
+def stage_dedup(ctx):
+	scrape_tiles.get_unique_tiles(ctx['img'], ctx['tile_size'])
+
+def stage_dedup_pure(ctx):
+	numpy, scrape_tiles.numpy = scrape_tiles.numpy, None
+	try:
+		scrape_tiles.get_unique_tiles(ctx['img'], ctx['tile_size'])
+	finally:
+		scrape_tiles.numpy = numpy
+
+def stage_vectorize(ctx):
+	tile_size = ctx['tile_size']
+	for tile, pos in zip(ctx['tiles'], ctx['positions']):
+		tti_tools.AnyImage(tile_size, pos, tile).vectorize_with_paths(merge=True)
+
+def stage_vectorize_markup(ctx):
+	tile_size = ctx['tile_size']
+	for tile, pos in zip(ctx['tiles'], ctx['positions']):
+		tti_tools.AnyImage(tile_size, pos, tile).vectorize_with_paths_markup(merge=True)
+
+def stage_encode(ctx):
+	tile_size = ctx['tile_size']
+	for tile in ctx['tiles']:
+		tti_datauri.make_data_uri(scrape_tiles.tile_image(tile, tile_size))
+
+def stage_serialize(ctx):
+	ctx['fragments'].write(ctx['document'], StringIO())
+
+STAGES = [
+	('decode', stage_decode),
+	('dedup', stage_dedup),
+	('dedup_pure', stage_dedup_pure),
+	('vectorize', stage_vectorize),
+	('vectorize_markup', stage_vectorize_markup),
+	('encode', stage_encode),
+	('serialize', stage_serialize),
+]
+
+def make_context(params):
+	"Everything the stages start from, built once and not timed."
+	img = make_screenshot(**params)
+	tile_size = params['tile_size']
+	tiles = unique_tiles(img, tile_size)
+	positions = tile_positions(tiles, tile_size)
+
+	document = inkex.etree.ElementTree(inkex.etree.fromstring(
+			'<svg xmlns="%s"><g/></svg>' % inkex.NSS['svg']))
+	layer = document.getroot()[0]
+	fragments = tti_tools.Fragments()
+	for tile, pos in zip(tiles, positions):
+		markup = tti_tools.AnyImage(tile_size, pos, tile).vectorize_with_paths_markup(True)
+		layer.append(fragments.attach(inkex.etree.Element(inkex.addNS('g', 'svg')), markup))
+
+	return {
+		'img': img,
+		'uri': tti_datauri.make_data_uri(img),
+		'tile_size': tile_size,
+		'tiles': tiles,
+		'positions': positions,
+		'document': document,
+		'fragments': fragments,
+	}
+
+def peak_growth(func, ctx):
+	"Peak memory growth in bytes of one call, None where it can't be measured."
+	try:
+		reset_peak()
+	except IOError:
+		return None
+	before = proc_status('VmRSS')
+	func(ctx)
+	return max(proc_status('VmHWM') - before, 0)
+
+def run_stage(func, ctx, repeat):
+	memory = peak_growth(func, ctx)
+	wall = cpu = None
+	for i in range(repeat):
+		start, start_cpu = time.time(), time.clock()
+		func(ctx)
+		elapsed, elapsed_cpu = time.time() - start, time.clock() - start_cpu
+		if wall is None or elapsed < wall:
+			wall, cpu = elapsed, elapsed_cpu
+	return {'seconds': wall, 'cpu_seconds': cpu, 'peak_bytes': memory}
+
+def run(params, stages, repeat):
+	ctx = make_context(params)
+	results = {
+		'params': params,
+		'unique_tiles': len(ctx['tiles']),
+		'numpy': scrape_tiles.numpy is not None,
+		'python': platform.python_version(),
+		'stages': {},
+	}
+	for name, func in STAGES:
+		if name in stages:
+			results['stages'][name] = run_stage(func, ctx, repeat)
+	results['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+	return results
+
+def format_memory(value):
+	if value is None:
+		return '       n/a'
+	return '%7.1f MB' % (value / 1e6)
+
+def report(results):
+	params = results['params']
+	print '%(width)dx%(height)d screenshot, %(tile_size)dpx tiles, %(colors)d colors,' \
+			' %(noise)g noise' % params,
+	print '%d unique tiles' % results['unique_tiles']
+	for name, func in STAGES:
+		stage = results['stages'].get(name)
+		if stage is not None:
+			print '%-17s %9.2fms %9.2fms cpu %s peak' % (name, stage['seconds'] * 1e3,
+					stage['cpu_seconds'] * 1e3, format_memory(stage['peak_bytes']))
+	print 'max rss %s' % format_memory(results['max_rss_bytes']).strip()
+
+def compare(results, baseline, threshold):
+	"""Print each stage's change against a baseline run, returns the names of
+	the stages that regressed by more than threshold."""
+	if results['params'] != baseline['params']:
+		print 'warning: baseline was run with %r' % (baseline['params'],)
+
+	regressions = []
+	for name, func in STAGES:
+		stage = results['stages'].get(name)
+		old = baseline['stages'].get(name)
+		if stage is None or old is None:
+			continue
+
+		ratio = stage['seconds'] / old['seconds'] if old['seconds'] else 1.0
+		flags = []
+		if ratio > 1 + threshold:
+			flags.append('SLOWER')
+
+		memory = stage['peak_bytes']
+		old_memory = old['peak_bytes']
+		if memory is not None and old_memory is not None and \
+				memory - old_memory > max(MIN_MEMORY_DELTA, old_memory * threshold):
+			flags.append('MORE MEMORY')
+
+		if flags:
+			regressions.append(name)
+		print '%-17s %9.2fms -> %9.2fms %6.2fx %s' % (name, old['seconds'] * 1e3,
+				stage['seconds'] * 1e3, ratio, ' '.join(flags))
+	return regressions
+
+def main(argv=None):
+	parser = optparse.OptionParser(usage = '%prog [options]')
+	parser.add_option('--width', type = 'int', default = 960)
+	parser.add_option('--height', type = 'int', default = 540)
+	parser.add_option('--tile-size', type = 'int', dest = 'tile_size', default = 12)
+	parser.add_option('--unique', type = 'float', default = 0.1,
+			help = 'Fraction of grid cells with a tile of their own')
+	parser.add_option('--colors', type = 'int', default = 16)
+	parser.add_option('--noise', type = 'float', default = 0.0,
+			help = 'Fraction of pixels nudged off their color')
+	parser.add_option('--seed', type = 'int', default = 0)
+	parser.add_option('--stages', default = ','.join(name for name, func in STAGES),
+			help = 'Comma separated stages to run')
+	parser.add_option('--repeat', type = 'int', default = 3,
+			help = 'Runs of each stage, the fastest counts')
+	parser.add_option('--output', default = '',
+			help = 'Save the results to this JSON file')
+	parser.add_option('--compare', default = '',
+			help = 'Compare against results saved with --output')
+	parser.add_option('--threshold', type = 'float', default = 0.1,
+			help = 'How much slower, as a fraction, counts as a regression')
+	options, args = parser.parse_args(argv)
+
+	params = dict((name, getattr(options, name)) for name in
+			('width', 'height', 'tile_size', 'unique', 'colors', 'noise', 'seed'))
+	stages = options.stages.split(',')
+	unknown = set(stages) - set(name for name, func in STAGES)
+	if unknown:
+		parser.error('Unknown stages: %s' % ', '.join(sorted(unknown)))
+
+	results = run(params, stages, options.repeat)
+	report(results)
+
+	if options.output:
+		with open(options.output, 'w') as f:
+			json.dump(results, f, indent = 1, separators = (',', ': '), sort_keys = True)
+
+	if options.compare:
+		with open(options.compare) as f:
+			baseline = json.load(f)
+		if compare(results, baseline, options.threshold):
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Reproducible synthetic screenshots of a tiled game screen.
+
+A tileset of random tiles is drawn from a palette and laid out on the grid,
+so the number of unique tiles is known up front. Noise nudges a fraction of
+the pixels by a level or two, as lossy captures do, which turns clean tiles
+into near duplicates.
+
+Run from the repository root to save one:
+    python benchmarks/synthetic.py out.png [width height tile_size unique colors noise seed]
+"""
+import random
+import sys
+
+from PIL import Image
+
+def make_tileset(count, tile_size=12, colors=16, seed=0):
+	"""count distinct tiles, each a base color with a scattering of others
+	from a palette of colors, as a list of RGB Images."""
+	rng = random.Random(seed)
+	palette = [(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+			   for i in range(colors)]
+	tiles = []
+	seen = set()
+	while len(tiles) < count:
+		base = rng.choice(palette)
+		pixels = [base if rng.random() < 0.6 else rng.choice(palette)
+				  for i in range(tile_size ** 2)]
+		key = tuple(pixels)
+		if key in seen:
+			if len(seen) >= colors ** (tile_size ** 2):
+				break
+			continue
+		seen.add(key)
+		tile = Image.new('RGB', (tile_size, tile_size))
+		tile.putdata(pixels)
+		tiles.append(tile)
+	return tiles
+
+def make_screenshot(width=960, height=540, tile_size=12, unique=0.1, colors=16,
+		noise=0.0, seed=0):
+	"""A width x height screenshot tiled on a tile_size grid from the upper left.
+
+	unique is the fraction of grid cells with a tile of their own, the rest
+	repeat those. noise is the fraction of pixels nudged off their color."""
+	rng = random.Random(seed)
+	columns = width // tile_size
+	rows = height // tile_size
+	cells = columns * rows
+	count = max(1, min(cells, int(round(cells * unique))))
+	tiles = make_tileset(count, tile_size, colors, seed)
+
+	# Every tile appears at least once, shuffled among the repeats.
+	layout = range(len(tiles)) + [rng.randrange(len(tiles))
+			for i in range(cells - len(tiles))]
+	rng.shuffle(layout)
+
+	img = Image.new('RGB', (width, height))
+	for i, tile in enumerate(layout):
+		img.paste(tiles[tile], ((i % columns) * tile_size, (i // columns) * tile_size))
+
+	if noise:
+		pixels = img.load()
+		for i in xrange(int(width * height * noise)):
+			x, y = rng.randrange(width), rng.randrange(height)
+			pixels[x, y] = tuple(min(255, max(0, c + rng.choice((-2, -1, 1, 2))))
+					for c in pixels[x, y])
+	return img
+
+def main(path, width=960, height=540, tile_size=12, unique=0.1, colors=16,
+		noise=0.0, seed=0):
+	make_screenshot(int(width), int(height), int(tile_size), float(unique),
+			int(colors), float(noise), int(seed)).save(path)
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
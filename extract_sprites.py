@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+import hashlib
+import logging
+import sys
+
+import inkex
+import tti_pack
+import tti_tools
+
+from PIL import Image
+from tti_datauri import decode_uri, make_data_uri
+
+from scrape_tiles import align_to_grid, connected_components, image_pixels, \
+		tile_blocks, numpy
+
+logging.basicConfig(
+	level=logging.ERROR,
+	stream=sys.stderr
+)
+
+# How many pixels of a cell are compared against every background tile to
+# shortlist the ones worth comparing in full.
+SAMPLES = 32
+SHORTLIST = 3
+
+def known_tile_images(layers, vector_tiles):
+	"""Yield an RGB Image of every tile on the Tileset Layers: the <image>
+	tiles, the rects shown through an atlas and the vector tiles, each distinct
+	vector tile once. vector_tiles is a tti_tools.VectorTiles to decode them."""
+	image = inkex.addNS('image', 'svg')
+	rect = inkex.addNS('rect', 'svg')
+	vectors = set()
+	for layer in layers:
+		atlas = None
+		for element in layer.iterchildren():
+			if element.tag == image:
+				img = Image.open(decode_uri(inkex.getHref(element)))
+				yield img.convert('RGB')
+			elif element.tag == rect and element.get(inkex.addNS('digest', 'tti')):
+				if atlas is None:
+					atlas = tti_tools.layer_atlas(layer)
+				if atlas is None:
+					continue
+				x = int(round(inkex.unittouu(element.get('x', '0'))))
+				y = int(round(inkex.unittouu(element.get('y', '0'))))
+				width = int(round(inkex.unittouu(element.get('width'))))
+				height = int(round(inkex.unittouu(element.get('height'))))
+				yield atlas.crop((x, y, x + width, y + height))
+			else:
+				decoded = vector_tiles.decode(element)
+				if decoded is not None and decoded[0] not in vectors:
+					vectors.add(decoded[0])
+					yield decoded[1].rasterize()
+
+class BackgroundMatcher(object):
+	"""Finds the known background tile behind each cell of a screenshot.
+
+	A cell matches a background when at least coverage of its pixels are
+	within tolerance of it, every other pixel is foreground. Cells that are
+	pure background are found by their bytes, the rest are compared on a few
+	sampled pixels against every background and in full against the best
+	few of those.
+	"""
+	def __init__(self, images, tile_size, tolerance=0, coverage=0.5):
+		self.tile_size = tile_size
+		self.tolerance = tolerance
+		self.pixels = tile_size ** 2
+		self.coverage = coverage
+
+		backgrounds = [image_pixels(img) for img in images
+				if img.size == (tile_size, tile_size)]
+		if backgrounds:
+			self.backgrounds = numpy.array(backgrounds).reshape(len(backgrounds), -1, 3)
+		else:
+			self.backgrounds = numpy.zeros((0, self.pixels, 3), numpy.uint8)
+		self.exact = {}
+		for i, background in enumerate(self.backgrounds):
+			self.exact.setdefault(background.tobytes(), i)
+
+		random = numpy.random.RandomState(0)
+		self.samples = numpy.sort(random.choice(self.pixels,
+				min(SAMPLES, self.pixels), replace=False))
+		self.sampled = self.backgrounds[:, self.samples].astype(numpy.int16)
+
+	def __len__(self):
+		return len(self.backgrounds)
+
+	def near(self, a, b):
+		"Which pixels of two (..., pixels, 3) arrays are within tolerance."
+		if not self.tolerance:
+			return (a == b).all(axis=-1)
+		return (numpy.abs(a.astype(numpy.int16) - b) <= self.tolerance).all(axis=-1)
+
+	def match(self, cells, chunk=256):
+		"""Match an (n, tile, tile, 3) array of cells, returning the index of
+		each cell's background, -1 where there's none."""
+		count = len(cells)
+		flat = cells.reshape(count, -1, 3)
+		best = numpy.empty(count, numpy.intp)
+		for i in xrange(count):
+			best[i] = self.exact.get(flat[i].tobytes(), -1)
+
+		rest = numpy.flatnonzero(best < 0)
+		shortlist = min(SHORTLIST, len(self))
+		for start in xrange(0, len(rest) if shortlist else 0, chunk):
+			which = rest[start:start + chunk]
+			sampled = flat[which][:, self.samples].astype(numpy.int16)
+			scores = self.near(sampled[:, numpy.newaxis], self.sampled).sum(axis=2)
+			candidates = numpy.argsort(-scores, axis=1, kind='mergesort')[:, :shortlist]
+
+			best_count = numpy.zeros(len(which), numpy.intp)
+			for column in candidates.T:
+				matched = self.near(flat[which], self.backgrounds[column]).sum(axis=1)
+				better = matched > best_count
+				best_count[better] = matched[better]
+				best[which[better]] = column[better]
+			best[which[best_count < self.coverage * self.pixels]] = -1
+		return best
+
+	def foreground(self, cells, best):
+		"""The (n, tile, tile) mask of pixels differing from each cell's
+		background, cells without one have no foreground."""
+		count = len(cells)
+		flat = cells.reshape(count, -1, 3)
+		foreground = numpy.zeros((count, self.pixels), bool)
+		matched = numpy.flatnonzero(best >= 0)
+		if len(matched):
+			foreground[matched] = ~self.near(flat[matched], self.backgrounds[best[matched]])
+		return foreground.reshape(count, self.tile_size, self.tile_size)
+
+class Frame(object):
+	"A grid aligned screenshot split into cells, and the background of each."
+	def __init__(self, img, matcher, align=True):
+		img = img.convert('RGB')
+		self.origin = (0, 0)
+		if align:
+			img, self.origin = align_to_grid(img, matcher.tile_size)
+		tile_size = matcher.tile_size
+		pixels = image_pixels(img)
+		height, width = pixels.shape[:2]
+		self.pixels = pixels[:height - height % tile_size, :width - width % tile_size]
+		blocks = tile_blocks(self.pixels, tile_size)
+		self.rows, self.columns = blocks.shape[:2]
+		self.cells = numpy.ascontiguousarray(blocks).reshape(-1, tile_size, tile_size, 3)
+		self.best = matcher.match(self.cells)
+
+	def positions(self, tile_size):
+		"The (x, y) of every cell in the uncropped screenshot, row by row."
+		cells = numpy.arange(len(self.cells))
+		xs = cells % self.columns * tile_size + self.origin[0]
+		ys = cells // self.columns * tile_size + self.origin[1]
+		return zip(xs.tolist(), ys.tolist())
+
+	def mask(self, matcher):
+		"The foreground of the frame as a (height, width) mask."
+		tile_size = matcher.tile_size
+		foreground = matcher.foreground(self.cells, self.best)
+		mask = foreground.reshape(self.rows, self.columns, tile_size, tile_size).swapaxes(1, 2)
+		return mask.reshape(self.rows * tile_size, self.columns * tile_size)
+
+def fill_backgrounds(frames, tile_size):
+	"""Give cells with no background match the background most often matched
+	at the same spot of the other frames.
+
+	A cell mostly covered by a sprite has too little background showing to
+	match on its own, but in a capture batch the same spot is usually clear
+	in some other frame."""
+	votes = {}
+	for frame in frames:
+		for position, best in zip(frame.positions(tile_size), frame.best):
+			if best >= 0:
+				counts = votes.setdefault(position, {})
+				counts[best] = counts.get(best, 0) + 1
+	for frame in frames:
+		for i, position in enumerate(frame.positions(tile_size)):
+			if frame.best[i] < 0 and position in votes:
+				counts = votes[position]
+				frame.best[i] = max(counts, key = lambda best: (counts[best], -best))
+
+def label_sprites(mask):
+	"""Find the 8-connected components of a foreground mask, returning their
+	flat pixel indices grouped by component."""
+	height, width = mask.shape
+	pixels = mask.ravel()
+	edges = []
+	for dy, dx in ((0, 1), (1, 0), (1, 1), (1, -1)):
+		left = max(-dx, 0)
+		right = width - max(dx, 0)
+		joined = mask[:height - dy, left:right] & mask[dy:, left + dx:right + dx]
+		ys, xs = numpy.nonzero(joined)
+		source = ys * width + xs + left
+		edges.append((source, source + dy * width + dx))
+	sources = numpy.concatenate([source for source, target in edges])
+	targets = numpy.concatenate([target for source, target in edges])
+
+	labels = connected_components(len(pixels), sources, targets)
+	members = numpy.flatnonzero(pixels)
+	order = members[numpy.argsort(labels[members], kind='mergesort')]
+	starts = numpy.flatnonzero(numpy.diff(labels[order])) + 1
+	return numpy.split(order, starts) if len(order) else []
+
+def crop_sprite(pixels, members):
+	"""Cut one component out of a screenshot as an RGBA Image, transparent
+	outside the component, and the (x, y) of its top left corner."""
+	width = pixels.shape[1]
+	ys, xs = members // width, members % width
+	top, left = ys.min(), xs.min()
+	bottom, right = ys.max() + 1, xs.max() + 1
+
+	sprite = numpy.zeros((bottom - top, right - left, 4), numpy.uint8)
+	sprite[ys - top, xs - left, :3] = pixels[ys, xs]
+	sprite[ys - top, xs - left, 3] = 255
+	return Image.fromarray(sprite, 'RGBA'), (left, top)
+
+def sprite_digest(img):
+	"Content address of a sprite, the SHA-1 of its size and RGBA bytes."
+	return hashlib.sha1('%dx%d:' % img.size +
+			numpy.asarray(img).tobytes()).hexdigest()
+
+def extract_sprites(images, matcher, align=True, min_pixels=4):
+	"""Difference a batch of screenshots against the known background tiles
+	and yield every foreground component of at least min_pixels as an RGBA
+	Image, frame by frame."""
+	frames = [Frame(img, matcher, align) for img in images]
+	fill_backgrounds(frames, matcher.tile_size)
+	for frame in frames:
+		mask = frame.mask(matcher)
+		logging.info("%d of %d cells have a background" % ((frame.best >= 0).sum(), len(frame.best)))
+		for members in label_sprites(mask):
+			if len(members) >= min_pixels:
+				yield crop_sprite(frame.pixels, members)[0]
+
+class ExtractSprites(inkex.Effect):
+	def __init__(self):
+		inkex.Effect.__init__(self)
+		self.lazy_payloads = True
+
+		self.OptionParser.add_option('-s', '--size',
+						action = 'store', type = 'int',
+						dest = 'tile_size', default = 12,
+						help = 'What is the size of a tile in pixels?')
+
+		self.OptionParser.add_option('-a', '--align',
+						action = 'store', type = 'inkbool',
+						dest = 'align', default = True,
+						help = 'Find the tile grid in screenshots that are not cropped to it?')
+
+		self.OptionParser.add_option('-t', '--tolerance',
+						action = 'store', type = 'int',
+						dest = 'tolerance', default = 0,
+						help = 'How many color levels apart can background pixels be?')
+
+		self.OptionParser.add_option('-b', '--coverage',
+						action = 'store', type = 'int',
+						dest = 'coverage', default = 50,
+						help = 'What percentage of a cell must match a background tile?')
+
+		self.OptionParser.add_option('-n', '--min-pixels',
+						action = 'store', type = 'int',
+						dest = 'min_pixels', default = 4,
+						help = 'How many pixels must a sprite have?')
+
+		self.OptionParser.add_option('-d', '--padding',
+						action = 'store', type = 'int',
+						dest = 'padding', default = 1,
+						help = 'Pixels left clear between sprites on the Sprite Layer')
+
+	def effect(self):
+		if numpy is None:
+			inkex.errormsg("Extracting sprites needs NumPy.")
+			return
+		tile_size = self.options.tile_size
+
+		with inkex.profile.phase('backgrounds'):
+			matcher = BackgroundMatcher(
+				known_tile_images(self.getLayersByLabel('Tileset Layer'),
+						tti_tools.VectorTiles(tile_size, self.getElementById)),
+				tile_size,
+				tolerance = self.options.tolerance,
+				coverage = self.options.coverage / 100.0
+			)
+		if not len(matcher):
+			inkex.errormsg("Scrape some tiles onto a Tileset Layer first, they're the backgrounds sprites are cut out of.")
+			return
+
+		sprite_layer = self.sprite_layer()
+		known = {}
+		for element in sprite_layer.iterchildren():
+			digest = element.get(inkex.addNS('digest', 'tti'))
+			if digest is not None:
+				known[digest] = element
+
+		sprites = []
+		counts = {}
+		images = (Image.open(decode_uri(uri)) for uri in self.gather_source_uris())
+		with inkex.profile.phase('extract'):
+			for sprite in extract_sprites(images, matcher, self.options.align,
+					self.options.min_pixels):
+				digest = sprite_digest(sprite)
+				if digest not in counts and digest not in known:
+					sprites.append((digest, sprite))
+				counts[digest] = counts.get(digest, 0) + 1
+		inkex.profile.count('unique_sprites', len(sprites))
+		logging.info("Found %d new sprites" % len(sprites))
+
+		with inkex.profile.phase('place'):
+			self.place_sprites(sprite_layer, sprites)
+		for element in sprite_layer.iterchildren():
+			digest = element.get(inkex.addNS('digest', 'tti'))
+			if digest in counts:
+				element.set(inkex.addNS('count', 'tti'), str(counts[digest]))
+
+	def output(self):
+		tti_tools.declare_namespace(self.document)
+		inkex.Effect.output(self)
+
+	def sprite_layer(self):
+		"The last Sprite Layer, made if there isn't one."
+		layers = self.getLayersByLabel('Sprite Layer')
+		if layers:
+			return layers[-1]
+		root = self.document.getroot()
+		layer = inkex.etree.SubElement(root, inkex.addNS('g', 'svg'))
+		layer.set(inkex.addNS('label', 'inkscape'), 'Sprite Layer')
+		layer.set(inkex.addNS('groupmode', 'inkscape'), 'layer')
+		self.indexNode(layer)
+		return layer
+
+	def place_sprites(self, layer, sprites):
+		"Pack new sprites onto the layer below the ones already there."
+		if not sprites:
+			return
+		top = 0
+		for element in layer.iterchildren(inkex.addNS('image', 'svg')):
+			bottom = inkex.unittouu(element.get('y', '0')) + inkex.unittouu(element.get('height', '0'))
+			top = max(top, int(bottom) + self.options.padding)
+
+		width = int(inkex.unittouu(self.document.getroot().get('width')))
+		width = max([width] + [sprite.size[0] for digest, sprite in sprites])
+		size, positions = tti_pack.pack([sprite.size for digest, sprite in sprites],
+				width = width, padding = self.options.padding, power_of_two = False)
+
+		for (digest, sprite), (x, y) in zip(sprites, positions):
+			img = inkex.etree.SubElement(layer, inkex.addNS('image', 'svg'), {
+				'x': str(x),
+				'y': str(y + top),
+				'width': str(sprite.size[0]),
+				'height': str(sprite.size[1]),
+			})
+			img.set(inkex.addNS('href', 'xlink'), make_data_uri(sprite))
+			img.set(inkex.addNS('digest', 'tti'), digest)
+
+	def gather_source_uris(self):
+		image = inkex.addNS('image', 'svg')
+		for layer in self.getLayersByLabel('Source Layer'):
+			for source in layer.iterchildren(image):
+				yield inkex.getHref(source)
+
+if __name__ == '__main__':
+	effect = ExtractSprites()
+	effect.affect()
@@ -19,9 +19,10 @@ You should have received a copy of the GNU General Public License
 along with this program; if not, write to the Free Software
 Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 """
-import sys, copy, optparse, random, re
+import sys, atexit, copy, json, optparse, os, random, re, shutil, tempfile, time
 import gettext
 from math import *
+from simplestyle import memoize
 _ = gettext.gettext
 
 #a dictionary of all of the xmlns prefixes in a standard inkscape doc
@@ -40,13 +41,14 @@ u'xml'      :u'http://www.w3.org/XML/1998/namespace'
 #a dictionary of unit to user unit conversion factors
 uuconv = {'in':90.0, 'pt':1.25, 'px':1, 'mm':3.5433070866, 'cm':35.433070866, 'm':3543.3070866,
           'km':3543307.0866, 'pc':15.0, 'yd':3240 , 'ft':1080}
+unit_pattern = re.compile('(%s)$' % '|'.join(uuconv.keys()))
+param_pattern = re.compile(r'(([-+]?[0-9]+(\.[0-9]*)?|[-+]?\.[0-9]+)([eE][-+]?[0-9]+)?)')
+
+@memoize(1024)
 def unittouu(string):
     '''Returns userunits given a string representation of units in another system'''
-    unit = re.compile('(%s)$' % '|'.join(uuconv.keys()))
-    param = re.compile(r'(([-+]?[0-9]+(\.[0-9]*)?|[-+]?\.[0-9]+)([eE][-+]?[0-9]+)?)')
-
-    p = param.match(string)
-    u = unit.search(string)    
+    p = param_pattern.match(string)
+    u = unit_pattern.search(string)
     if p:
         retval = float(p.string[p.start():p.end()])
     else:
@@ -86,6 +88,323 @@ def errormsg(msg):
     """
     sys.stderr.write((unicode(msg) + "\n").encode("UTF-8"))
 
+class _Phase(object):
+    """A timed phase of a Profile, see Profile.phase."""
+    __slots__ = ('totals', 'wall', 'cpu')
+
+    def __init__(self, totals):
+        self.totals = totals
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = time.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        totals = self.totals
+        totals[0] += time.time() - self.wall
+        totals[1] += time.clock() - self.cpu
+        totals[2] += 1
+        return False
+
+class _NoPhase(object):
+    """Stands in for a _Phase while profiling is off."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_no_phase = _NoPhase()
+
+class Profile(object):
+    """Wall and CPU time per named phase of an effect, plus counters.
+
+       Phases may nest, each is timed on its own, so a phase's time includes
+       the phases inside it. While it is off, which it is unless enabled,
+       phase() hands back a shared do-nothing context manager and count()
+       returns straight away:
+
+         with inkex.profile.phase('hash'):
+             ...
+         inkex.profile.count('tiles_scanned', len(cells))
+    """
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.order = []
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+        self.started = (time.time(), time.clock())
+
+    def phase(self, name):
+        if not self.enabled:
+            return _no_phase
+        totals = self.phases.get(name)
+        if totals is None:
+            totals = self.phases[name] = [0.0, 0.0, 0]
+            self.order.append(name)
+        return _Phase(totals)
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        """The phases and counters recorded so far, as a dict ready for JSON."""
+        phases = []
+        for name in self.order:
+            wall, cpu, calls = self.phases[name]
+            phases.append({'name': name, 'wall': wall, 'cpu': cpu, 'calls': calls})
+        report = {'phases': phases, 'counters': dict(self.counters)}
+        if self.enabled:
+            report['wall'] = time.time() - self.started[0]
+            report['cpu'] = time.clock() - self.started[1]
+        try:
+            import resource
+            report['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            pass
+        return report
+
+    def write(self, destination='-', **extra):
+        """Write the report as JSON to a file, or to stderr for '-'."""
+        report = self.report()
+        report.update(extra)
+        data = json.dumps(report, indent=1, separators=(',', ': '), sort_keys=True)
+        if destination == '-':
+            sys.stderr.write(data + "\n")
+        else:
+            with open(destination, 'w') as f:
+                f.write(data + "\n")
+
+# The Profile every effect and the modules it uses report to.
+profile = Profile()
+
+class _CountingStream(object):
+    """Wraps a stream, counting the bytes read or written through it."""
+    def __init__(self, stream, counter):
+        self.stream = stream
+        self.counter = counter
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        profile.count(self.counter, len(data))
+        return data
+
+    def write(self, data):
+        profile.count(self.counter, len(data))
+        self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+# Attribute values at least this long are left out of lazily parsed trees.
+PAYLOAD_THRESHOLD = 64 * 1024
+
+_entity_pattern = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+_entities = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+def _unescape_entity(match):
+    name = match.group(1)
+    if name.startswith('#x'):
+        return unichr(int(name[2:], 16)).encode('utf-8')
+    if name.startswith('#'):
+        return unichr(int(name[1:])).encode('utf-8')
+    return _entities[name]
+
+class Payload(object):
+    """A large attribute value, such as an embedded screenshot, that was left
+       in the file it was parsed from rather than loaded into the tree.
+
+       It is only a path and an offset, so it is cheap to keep and to hand to
+       other processes, and read() loads the value when it's needed."""
+    def __init__(self, path, offset, length, escaped=False):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.escaped = escaped
+
+    def __len__(self):
+        return self.length
+
+    def raw(self):
+        """The value as it is written in the file, entities and all."""
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+
+    def read(self):
+        """The attribute value."""
+        value = self.raw()
+        if self.escaped:
+            value = _entity_pattern.sub(_unescape_entity, value)
+        return value
+
+    def copy(self, stream, chunk=1 << 20):
+        """Write the value as it is written in the file to a stream, a chunk
+           at a time."""
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            left = self.length
+            while left > 0:
+                data = f.read(min(chunk, left))
+                if not data:
+                    break
+                stream.write(data)
+                left -= len(data)
+
+class Payloads(object):
+    """The Payloads of a lazily parsed document.
+
+       Where a payload was, the tree holds a short marker, which getHref turns
+       back into its Payload and writer() turns back into the original value
+       as the document is written out."""
+    def __init__(self):
+        self.marker = 'inkex-payload-%x-' % random.getrandbits(64)
+        self.pattern = re.compile(re.escape(self.marker) + r'(\d+);')
+        self.handles = []
+
+    def __len__(self):
+        return len(self.handles)
+
+    def add(self, payload):
+        """Keep a Payload, returns the marker standing in for it."""
+        self.handles.append(payload)
+        return '%s%d;' % (self.marker, len(self.handles) - 1)
+
+    def resolve(self, value):
+        """The Payload a marker stands for, anything else is returned as is."""
+        if value is not None and value.startswith(self.marker):
+            match = self.pattern.match(value)
+            if match and match.end() == len(value):
+                return self.handles[int(match.group(1))]
+        return value
+
+    def scan(self, stream, path, feed, threshold=PAYLOAD_THRESHOLD):
+        """Read an XML file from stream, found at path, passing it on to feed
+           with every quoted data: value of at least threshold bytes swapped
+           for a marker. Only threshold bytes of a value are ever held."""
+        chunk = max(threshold, 1 << 16)
+        data = stream.read(chunk)
+        base = 0
+        eof = not data
+        while True:
+            start = data.find('data:', 1)
+            while start != -1 and data[start - 1] not in '"\'':
+                start = data.find('data:', start + 1)
+            if start == -1:
+                if eof:
+                    feed(data)
+                    return
+                # Keep enough to find a quote and data: split across reads
+                keep = min(len(data), 5)
+                feed(data[:len(data) - keep])
+                base += len(data) - keep
+                more = stream.read(chunk)
+                eof = not more
+                data = data[len(data) - keep:] + more
+                continue
+
+            quote = data[start - 1]
+            end = data.find(quote, start)
+            while end == -1 and len(data) - start < threshold and not eof:
+                more = stream.read(chunk)
+                eof = not more
+                data += more
+                end = data.find(quote, start)
+            if end != -1 and end - start < threshold:
+                feed(data[:end])
+                base += end
+                data = data[end:]
+                continue
+
+            # A payload, skip over it to its closing quote.
+            feed(data[:start])
+            offset = base = base + start
+            data = data[start:]
+            if end != -1:
+                end -= start
+            seen = data if end == -1 else data[:end]
+            unsafe = '<' in seen or '"' in seen
+            escaped = '&' in seen
+            while end == -1:
+                base += len(data)
+                data = stream.read(chunk)
+                if not data:
+                    raise ValueError("Unterminated attribute value in %s" % path)
+                eof = False
+                end = data.find(quote)
+                seen = data if end == -1 else data[:end]
+                unsafe = unsafe or '<' in seen or '"' in seen
+                escaped = escaped or '&' in seen
+            payload = Payload(path, offset, base + end - offset, escaped)
+            if unsafe:
+                # It couldn't be written back verbatim between double quotes
+                feed(payload.raw())
+            else:
+                feed(self.add(payload))
+            base += end
+            data = data[end:]
+
+    def write(self, data, stream):
+        """Write serialized XML to a stream with every marker swapped back
+           for the payload it stands for."""
+        last = 0
+        for match in self.pattern.finditer(data):
+            stream.write(data[last:match.start()])
+            self.handles[int(match.group(1))].copy(stream)
+            last = match.end()
+        stream.write(data[last:])
+
+    def writer(self, stream):
+        """A file-like object writing through to stream, see write."""
+        return _PayloadWriter(self, stream)
+
+class _PayloadWriter(object):
+    """Holds back whatever follows the last '>' written, so markers split
+       across writes are still found."""
+    def __init__(self, payloads, stream):
+        self.payloads = payloads
+        self.stream = stream
+        self.pending = ''
+
+    def write(self, data):
+        data = self.pending + data
+        cut = data.rfind('>') + 1
+        self.payloads.write(data[:cut], self.stream)
+        self.pending = data[cut:]
+
+    def flush(self):
+        if self.pending:
+            self.payloads.write(self.pending, self.stream)
+            self.pending = ''
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+# The Payloads of the document the running effect parsed lazily.
+payloads = Payloads()
+
+def getHref(node):
+    """A node's xlink:href, or the Payload standing in for it in a lazily
+       parsed document. tti_datauri.decode_uri takes either."""
+    return payloads.resolve(node.get(addNS('href', 'xlink')))
+
+def _spool(stream):
+    """Copy a stream into a temporary file that lives as long as the process,
+       returns its path."""
+    spool = tempfile.NamedTemporaryFile(suffix='.svg', delete=False)
+    shutil.copyfileobj(stream, spool)
+    spool.close()
+    atexit.register(os.remove, spool.name)
+    return spool.name
+
 def check_inkbool(option, opt, value):
     if str(value).capitalize() == 'True':
         return True
@@ -113,12 +432,19 @@ class Effect:
         self.ctx=None
         self.selected={}
         self.doc_ids={}
+        self.id_map=None
+        self.layer_map=None
         self.options=None
         self.args=None
+        self.lazy_payloads=False
         self.OptionParser = optparse.OptionParser(usage="usage: %prog [options] SVGfile",option_class=InkOption)
         self.OptionParser.add_option("--id",
                         action="append", type="string", dest="ids", default=[], 
                         help="id attribute of object to manipulate")
+        self.OptionParser.add_option("--profile",
+                        action="store", type="string", dest="profile",
+                        default=os.environ.get("INKEX_PROFILE", ""),
+                        help="write a JSON report of where the time went to this file, or - for stderr")
 
     def effect(self):
         pass
@@ -136,9 +462,31 @@ class Effect:
                 stream = open(self.svg_file,'r')
         except:
             stream = sys.stdin
-        self.document = etree.parse(stream)
+        if self.lazy_payloads:
+            self.parseLazily(stream)
+            return
+        if profile.enabled:
+            stream = _CountingStream(stream, 'bytes_parsed')
+        self.document = etree.parse(stream, etree.XMLParser(huge_tree=True))
         stream.close()
 
+    def parseLazily(self, stream):
+        """Parse with every large data: URI left in the file, see Payloads.
+           The tree then stays small however many screenshots are embedded,
+           and each is only read when getHref's Payload is."""
+        path = getattr(stream, 'name', None)
+        if stream is sys.stdin or not path or not os.path.isfile(path):
+            path = _spool(stream)
+            stream.close()
+            stream = open(path, 'rb')
+        if profile.enabled:
+            stream = _CountingStream(stream, 'bytes_parsed')
+        parser = etree.XMLParser(huge_tree=True)
+        payloads.scan(stream, os.path.abspath(path), parser.feed)
+        stream.close()
+        self.document = parser.close().getroottree()
+        profile.count('lazy_payloads', len(payloads))
+
     def getposinlayer(self):
         #defaults
         self.current_layer = self.document.getroot()
@@ -146,10 +494,9 @@ class Effect:
 
         layerattr = self.document.xpath('//sodipodi:namedview/@inkscape:current-layer', namespaces=NSS)
         if layerattr:
-            layername = layerattr[0]
-            layer = self.document.xpath('//svg:g[@id="%s"]' % layername, namespaces=NSS)
-            if layer:
-                self.current_layer = layer[0]
+            layer = self.getElementById(layerattr[0])
+            if layer is not None and layer.tag == addNS('g','svg'):
+                self.current_layer = layer
 
         xattr = self.document.xpath('//sodipodi:namedview/@inkscape:cx', namespaces=NSS)
         yattr = self.document.xpath('//sodipodi:namedview/@inkscape:cy', namespaces=NSS)
@@ -163,29 +510,101 @@ class Effect:
     def getselected(self):
         """Collect selected nodes"""
         for i in self.options.ids:
-            path = '//*[@id="%s"]' % i
-            for node in self.document.xpath(path, namespaces=NSS):
+            node = self.getElementById(i)
+            if node is not None:
                 self.selected[i] = node
 
+    def buildIndexes(self):
+        """Index every id, and every labelled group, in one walk of the document"""
+        self.id_map = {}
+        self.layer_map = {}
+        self.indexNode(self.document.getroot())
+
+    def invalidateIndexes(self):
+        """Drop the lookup indexes, they are rebuilt on the next lookup
+
+        Call this after changing the document in ways indexNode and
+        removeNode don't cover, such as adding many nodes at once."""
+        self.id_map = None
+        self.layer_map = None
+
+    def indexNode(self, node):
+        """Add a node and its descendants to the lookup indexes
+
+        Call this after adding nodes to the document so getElementById and
+        getLayersByLabel see them; removeNode takes care of removals. Ids
+        that aren't in the indexes aren't looked for in the document."""
+        if self.id_map is None:
+            self.buildIndexes()
+            return
+        g = addNS('g','svg')
+        label_attr = addNS('label','inkscape')
+        for el in node.iter():
+            if not isinstance(el.tag, basestring):
+                continue
+            id = el.get('id')
+            if id is not None:
+                self.id_map.setdefault(id, el)
+                self.doc_ids[id] = 1
+            if el.tag == g:
+                label = el.get(label_attr)
+                if label is not None:
+                    self.layer_map.setdefault(label, []).append(el)
+
+    def removeNode(self, node):
+        """Remove a node from the document and drop it from the lookup indexes"""
+        parent = node.getparent()
+        if parent is not None:
+            parent.remove(node)
+        if self.id_map is None:
+            return
+        for el in node.iter():
+            if not isinstance(el.tag, basestring):
+                continue
+            id = el.get('id')
+            if id is not None and self.id_map.get(id) is el:
+                del self.id_map[id]
+            label = el.get(addNS('label','inkscape'))
+            if label in self.layer_map:
+                self.layer_map[label] = [l for l in self.layer_map[label] if l is not el]
+
+    def inDocument(self, node):
+        """Is node still attached to the document?"""
+        root = self.document.getroot()
+        while node is not None:
+            if node is root:
+                return True
+            node = node.getparent()
+        return False
+
     def getElementById(self, id):
-        path = '//*[@id="%s"]' % id
-        el_list = self.document.xpath(path, namespaces=NSS)
-        if el_list:
-          return el_list[0]
-        else:
-          return None
+        if self.id_map is None:
+            self.buildIndexes()
+        el = self.id_map.get(id)
+        if el is not None and (el.get('id') != id or not self.inDocument(el)):
+            # renamed or detached behind our back, so the index is stale
+            self.buildIndexes()
+            el = self.id_map.get(id)
+        return el
+
+    def getLayersByLabel(self, label):
+        """Return the groups labelled label, in document order"""
+        if self.layer_map is None:
+            self.buildIndexes()
+        label_attr = addNS('label','inkscape')
+        layers = [l for l in self.layer_map.get(label, [])
+                  if l.get(label_attr) == label and self.inDocument(l)]
+        self.layer_map[label] = layers
+        return list(layers)
 
     def getParentNode(self, node):
-        for parent in self.document.getiterator():
-            if node in parent.getchildren():
-                return parent
-                break
-
+        return node.getparent()
 
     def getdocids(self):
-        docIdNodes = self.document.xpath('//@id', namespaces=NSS)
-        for m in docIdNodes:
-            self.doc_ids[m] = 1
+        if self.id_map is None:
+            self.buildIndexes()
+        for id in self.id_map:
+            self.doc_ids[id] = 1
 
     def getNamedView(self):
         return self.document.xpath('//sodipodi:namedview', namespaces=NSS)[0]
@@ -208,12 +627,35 @@ class Effect:
         """Affect an SVG document with a callback effect"""
         self.svg_file = args[-1]
         self.getoptions(args)
-        self.parse()
-        self.getposinlayer()
-        self.getselected()
-        self.getdocids()
-        self.effect()
-        if output: self.output()
+        if self.options.profile:
+            profile.enable()
+        with profile.phase('parse'):
+            self.parse()
+        with profile.phase('index'):
+            self.getposinlayer()
+            self.getselected()
+            self.getdocids()
+        if profile.enabled:
+            nodes = sum(1 for node in self.document.iter())
+        with profile.phase('effect'):
+            self.effect()
+        if profile.enabled:
+            profile.count('svg_nodes_created',
+                    sum(1 for node in self.document.iter()) - nodes)
+        if output:
+            with profile.phase('output'):
+                stdout = sys.stdout
+                if profile.enabled:
+                    sys.stdout = _CountingStream(sys.stdout, 'output_bytes')
+                if len(payloads):
+                    sys.stdout = payloads.writer(sys.stdout)
+                try:
+                    self.output()
+                    sys.stdout.flush()
+                finally:
+                    sys.stdout = stdout
+        if profile.enabled:
+            profile.write(self.options.profile, effect=self.__class__.__name__)
 
     def uniqueId(self, old_id, make_new_id = True):
         new_id = old_id
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import logging
+import sys
+
+import inkex
+import tti_tools
+
+from tti_datauri import make_data_uri
+
+logging.basicConfig(
+	level=logging.ERROR,
+	stream=sys.stderr
+)
+
+class RasterizeTiles(inkex.Effect):
+	"""Turn the vector tiles Vectorize Tiles made back into raster ones.
+
+	Every <g> tile and every <use> of a tile symbol on a Tileset Layer is
+	decoded into its pixels and replaced by an <image>, or by a rect shown
+	through the layer's atlas. Each distinct tile is decoded and encoded once,
+	however often it is placed."""
+
+	def __init__(self):
+		inkex.Effect.__init__(self)
+		self.lazy_payloads = True
+
+		self.OptionParser.add_option('-s', '--size',
+						action = 'store', type = 'int',
+						dest = 'tile_size', default = '12',
+						help = 'What is the size of a tile in pixels?')
+
+		self.OptionParser.add_option('-a', '--all',
+						action = 'store', type = 'inkbool',
+						dest = 'all', default = False,
+						help = 'Rasterize all tileset layers?')
+
+		self.OptionParser.add_option('-x', '--atlas',
+						action = 'store', type = 'inkbool',
+						dest = 'atlas', default = False,
+						help = 'Show the rasterized tiles through one atlas image?')
+
+	def effect(self):
+		self.tile_size = tile_size = self.options.tile_size
+
+		if self.options.all:
+			layers = self.getLayersByLabel('Tileset Layer')
+		else:
+			layers = [self.current_layer]
+
+		root = self.document.getroot()
+		columns = inkex.unittouu(root.get('width', '0')) // tile_size
+
+		# Decoded tiles and their data URIs by digest.
+		self.images = {}
+		self.uris = {}
+		self.vector_tiles = tti_tools.VectorTiles(tile_size, self.getElementById)
+
+		for layer in layers:
+			if self.options.atlas:
+				atlas = tti_tools.TileAtlas(self.document, layer, columns,
+						tile_size, self.uniqueId)
+			else:
+				atlas = None
+
+			count = 0
+			for tile in list(layer.iterchildren(inkex.addNS('g', 'svg'),
+					inkex.addNS('use', 'svg'))):
+				decoded = self.decode_tile(tile)
+				if decoded is None:
+					continue
+				digest, any_img = decoded
+
+				if atlas is not None:
+					raster_tile = atlas.tile(any_img.pos, self.images[digest])
+					if any_img.transform:
+						raster_tile.set('transform', any_img.transform)
+				else:
+					raster_tile = self.build_raster_tile(digest, any_img)
+
+				# Carry the tile index bookkeeping over to the raster tile.
+				for name, value in tile.attrib.iteritems():
+					if name.startswith('{%s}' % inkex.NSS['tti']) or name == 'id':
+						raster_tile.set(name, value)
+				raster_tile.set(inkex.addNS('digest', 'tti'), digest)
+
+				layer.replace(tile, raster_tile)
+				count += 1
+			inkex.profile.count('tiles_scanned', count)
+
+			if atlas is not None and count:
+				with inkex.profile.phase('atlas'):
+					atlas.update()
+			logging.info("%d tiles rasterized, %d distinct" % (count, len(self.images)))
+
+	def decode_tile(self, tile):
+		"""The digest and AnyImage of a vector tile, its pixels rasterized
+		into self.images, None if it isn't a tile."""
+		decoded = self.vector_tiles.decode(tile)
+		if decoded is not None:
+			digest, any_img = decoded
+			if digest not in self.images:
+				with inkex.profile.phase('rasterize'):
+					self.images[digest] = any_img.rasterize()
+				inkex.profile.count('unique_tiles')
+		return decoded
+
+	def output(self):
+		tti_tools.declare_namespace(self.document)
+		inkex.Effect.output(self)
+
+	def build_raster_tile(self, digest, any_img):
+		uri = self.uris.get(digest)
+		if uri is None:
+			with inkex.profile.phase('encode'):
+				uri = self.uris[digest] = make_data_uri(self.images[digest])
+
+		img = inkex.etree.Element(inkex.addNS('image', 'svg'), {
+			'x': str(any_img.pos[0]),
+			'y': str(any_img.pos[1]),
+			'width': str(self.tile_size),
+			'height': str(self.tile_size),
+		})
+		img.set(inkex.addNS('href', 'xlink'), uri)
+		if any_img.transform:
+			img.set('transform', any_img.transform)
+		return img
+
+
+if __name__ == '__main__':
+	effect = RasterizeTiles()
+	effect.affect()
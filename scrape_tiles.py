@@ -1,16 +1,25 @@
 #!/usr/bin/env python
 import logging
 import itertools
+import json
+import multiprocessing
+import multiprocessing.managers
+import os
 import sys
-import urllib
-
-from cStringIO import StringIO
 
 import inkex
 import simplestyle
+import tti_cache
+import tti_pack
 import tti_tools
 
 from PIL import Image
+from tti_datauri import decode_uri, make_data_uri
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 logging.basicConfig(
 	level=logging.ERROR,
@@ -20,20 +29,6 @@ logging.basicConfig(
 def rgb2hex(rgb):
 	return "#%02X%02X%02X" % rgb
 
-def make_data_uri(img):
-	"Convert an Image to a base64 URI"
-	s = StringIO()
-	img.save(s, 'png')
-	s.seek(0)
-	img_s = ''.join(s.readlines()).encode('base64').translate(None, '\n')
-	return "data:image/png;base64,%s" % img_s
-
-def decode_uri(uri):
-	"Scrap a URI which suitable to pass to Image.open()"
-	if uri.startswith("file:///"):
-		return urllib.unquote(uri[len("file:///"):])
-	return StringIO(uri[uri.find("base64,") + len("base64,"):].decode('base64'))
-
 def get_unique_tiles_slowly(img, size=12):
 	logging.info("Gathering unique tiles...")
 	tiles = set()
@@ -59,9 +54,13 @@ def calculate_linear_slices(index, width, tile_size):
 	return slices
 
 def get_unique_tiles(img, tile_size=12):
+	"Gather the set of unique tiles, each a tuple of pixels, from an image."
+	if numpy is not None:
+		return get_unique_tiles_vectorized(img, tile_size)
+
 	logging.info("Gathering unique tiles...")
 
-	_, _, max_x, max_y = img.getbbox()
+	max_x, max_y = img.size
 
 	columns = max_x / float(tile_size)
 	rows = max_y / float(tile_size)
@@ -85,9 +84,742 @@ def get_unique_tiles(img, tile_size=12):
 	logging.info("Found %d unique tiles" % len(tiles))
 	return tiles
 
+def tile_blocks(pixels, tile_size):
+	"""View an (height, width, channels) pixel array as a
+	(rows, columns, tile, tile, channels) array of tiles without copying."""
+	height, width, channels = pixels.shape
+	rows = height // tile_size
+	columns = width // tile_size
+	blocks = pixels.reshape(rows, tile_size, columns, tile_size, channels)
+	return blocks.swapaxes(1, 2)
+
+def image_pixels(img):
+	"Get an image's pixels as a (height, width, channels) uint8 array."
+	pixels = numpy.asarray(img, dtype=numpy.uint8)
+	if pixels.ndim == 2:
+		pixels = pixels[:, :, numpy.newaxis]
+	return pixels
+
+def hash_tiles(flat):
+	"""Fold each row of an (n, bytes) uint8 array into a 64-bit digest.
+
+	The bytes are consumed a 64-bit word at a time, FNV style, so the whole
+	batch is hashed in as many numpy operations as there are words in a tile.
+	"""
+	count, length = flat.shape
+	padding = -length % 8
+	if padding:
+		flat = numpy.hstack((flat, numpy.zeros((count, padding), numpy.uint8)))
+	words = numpy.ascontiguousarray(flat).view('<u8')
+
+	digests = numpy.empty(count, numpy.uint64)
+	digests.fill(0xcbf29ce484222325)
+	prime = numpy.uint64(0x100000001b3)
+	for column in words.T:
+		digests ^= column
+		digests *= prime
+	return digests
+
+def find_unique_tiles(blocks):
+	"""Find the unique tiles of a block view in a single pass.
+
+	Returns the unique tiles as an (n, tile, tile, channels) array along with
+	a (rows, columns) array indexing each grid cell into them.
+	"""
+	rows, columns, tile_size, _, channels = blocks.shape
+	flat = numpy.ascontiguousarray(blocks).reshape(rows * columns, -1)
+
+	digests = hash_tiles(flat)
+	_, first, inverse = numpy.unique(digests,
+			return_index=True, return_inverse=True)
+
+	# A 64-bit collision is astronomically unlikely but cheap to rule out, if
+	# it does happen fall back to comparing the raw bytes of every tile.
+	if not (flat[first][inverse] == flat).all():
+		keys = flat.view(numpy.dtype((numpy.void, flat.shape[1]))).ravel()
+		_, first, inverse = numpy.unique(keys,
+				return_index=True, return_inverse=True)
+
+	tiles = flat[first].reshape(-1, tile_size, tile_size, channels)
+	return tiles, inverse.reshape(rows, columns)
+
+def tile_to_tuple(tile):
+	"Convert a (tile, tile, channels) array into a tuple of pixels."
+	if tile.shape[-1] == 1:
+		return tuple(tile.ravel().tolist())
+	return tuple(map(tuple, tile.reshape(-1, tile.shape[-1]).tolist()))
+
+def get_unique_tiles_vectorized(img, tile_size=12):
+	logging.info("Gathering unique tiles...")
+
+	width, height = img.size
+	# Same as above, anything not on the grid is kicked back.
+	if width % tile_size or height % tile_size:
+		return set()
+
+	blocks = tile_blocks(image_pixels(img), tile_size)
+	unique, _ = find_unique_tiles(blocks)
+	tiles = set(tile_to_tuple(tile) for tile in unique)
+	logging.info("Found %d unique tiles" % len(tiles))
+	return tiles
+
+def iter_tile_bands(img, tile_size=12):
+	"Yield an image one row of tiles at a time."
+	width, height = img.size
+	for top in range(0, height - tile_size + 1, tile_size):
+		yield img.crop((0, top, width, top + tile_size))
+
+def get_unique_tiles_streaming(img, tile_size=12):
+	"""Gather the same tiles as get_unique_tiles but one band of tiles at a
+	time, so only a width x tile_size slice of the image is ever expanded."""
+	logging.info("Streaming unique tiles...")
+
+	width, height = img.size
+	if width % tile_size or height % tile_size:
+		return set()
+
+	if numpy is None:
+		tiles = set()
+		for band in iter_tile_bands(img, tile_size):
+			tiles |= get_unique_tiles(band, tile_size)
+	else:
+		tiles = set(tti_tools.tile_from_bytes(payload, tile_size)
+				for payload in get_unique_payloads(img, tile_size, True))
+	logging.info("Found %d unique tiles" % len(tiles))
+	return tiles
+
+def get_unique_payloads(img, tile_size=12, stream=False, symmetric=False):
+	"""Gather the unique tiles of an image as strings of raw pixel bytes, which
+	are far cheaper to hash, pickle and compare than tuples of pixels."""
+	if numpy is None and not symmetric:
+		if stream:
+			tiles = get_unique_tiles_streaming(img, tile_size)
+		else:
+			tiles = get_unique_tiles(img, tile_size)
+		return set(tti_tools.tile_bytes(tile) for tile in tiles)
+
+	return set(get_tile_grid(img, tile_size, stream, symmetric)[0])
+
+def get_tile_grid(img, tile_size=12, stream=False, symmetric=False):
+	"""Split an image into its unique tiles and a map of where each one is.
+
+	Returns the unique tiles as a list of payloads in the order they're first
+	found, and a row major sequence with the index of every grid cell's tile
+	in that list. Images that aren't a multiple of tile_size have no tiles.
+
+	With symmetric, rotated and mirrored copies of a tile count as the same
+	tile, see canonicalize_tiles, and a third sequence holds the
+	tti_tools.DIHEDRAL transform of each cell. Otherwise that's None.
+	"""
+	width, height = img.size
+	if width % tile_size or height % tile_size:
+		return [], [], symmetric and [] or None
+
+	payloads = []
+	lookup = {}
+
+	if numpy is None:
+		permutations = tti_tools.dihedral_permutations(tile_size)
+		cells = []
+		transforms = []
+		for band in iter_tile_bands(img, tile_size):
+			pixels = tuple(band.getdata())
+			for x in range(0, width // tile_size):
+				slices = calculate_linear_slices((x, 0), width, tile_size)
+				tile = tuple(itertools.chain.from_iterable(pixels[s] for s in slices))
+				if symmetric:
+					payload, transform = canonicalize_tile(tile, permutations)
+					transforms.append(transform)
+				else:
+					payload = tti_tools.tile_bytes(tile)
+				if payload not in lookup:
+					lookup[payload] = len(payloads)
+					payloads.append(payload)
+				cells.append(lookup[payload])
+		return payloads, cells, symmetric and transforms or None
+
+	if stream:
+		bands = iter_tile_bands(img, tile_size)
+	else:
+		bands = [img]
+
+	cells = []
+	transforms = []
+	for band in bands:
+		unique, inverse = find_unique_tiles(tile_blocks(image_pixels(band), tile_size))
+		if symmetric:
+			unique, transform = canonicalize_tiles(unique)
+			transforms.append(transform[inverse].ravel())
+
+		# Number the band's tiles in the order they first appear in it, as
+		# find_unique_tiles orders them by hash.
+		first = numpy.unique(inverse, return_index=True)[1]
+		local = numpy.empty(len(unique), numpy.intp)
+		for i in numpy.argsort(first, kind='mergesort'):
+			payload = unique[i].tobytes()
+			if payload not in lookup:
+				lookup[payload] = len(payloads)
+				payloads.append(payload)
+			local[i] = lookup[payload]
+		cells.append(local[inverse].ravel())
+
+	if symmetric:
+		transforms = numpy.concatenate(transforms)
+	else:
+		transforms = None
+	return payloads, numpy.concatenate(cells), transforms
+
+def canonicalize_tile(tile, permutations):
+	"""Canonicalize a tuple of pixels over its rotations and reflections, the
+	pure Python version of canonicalize_tiles. Returns the canonical payload
+	and the transform turning it back into the tile."""
+	variants = [tti_tools.tile_bytes(tile[i] for i in permutation)
+			for permutation in permutations]
+	chosen = variants.index(min(variants))
+	return variants[chosen], tti_tools.DIHEDRAL_INVERSE[chosen]
+
+def canonicalize_tiles(tiles):
+	"""Canonicalize an (n, tile, tile, channels) array of tiles over their 8
+	rotations and reflections.
+
+	The canonical form of a tile is whichever of its tti_tools.DIHEDRAL
+	variants has the lowest bytes, picked for every tile at once by narrowing
+	down the candidates a byte column at a time. Returns the canonical tiles
+	and, for each, the transform that turns it back into the original.
+	"""
+	count, tile_size, _, channels = tiles.shape
+	pixels = tiles.reshape(count, tile_size ** 2, channels)
+	variants = numpy.concatenate([pixels[:, numpy.newaxis, permutation]
+			for permutation in tti_tools.dihedral_permutations(tile_size)], axis=1)
+	variants = variants.reshape(count, len(tti_tools.DIHEDRAL), -1)
+
+	candidates = numpy.ones(variants.shape[:2], bool)
+	for column in range(0, variants.shape[2]):
+		values = numpy.where(candidates, variants[:, :, column], 256)
+		candidates &= values == values.min(axis=1)[:, numpy.newaxis]
+		if column % 8 == 7 and (candidates.sum(axis=1) == 1).all():
+			break
+
+	chosen = candidates.argmax(axis=1)
+	canonical = variants[numpy.arange(count), chosen].reshape(tiles.shape)
+	inverse = numpy.array(tti_tools.DIHEDRAL_INVERSE)
+	return canonical, inverse[chosen]
+
+# Screenshots bigger than this only have their grid found from bands of about
+# this many pixels, hashing takes around 24 bytes a pixel.
+GRID_SAMPLE_PIXELS = 1 << 21
+
+def _hash_weights(count, seed):
+	"""Fixed odd 64-bit multipliers so hashes are the same in every process,
+	scrambled with SplitMix64 so they aren't linearly related."""
+	mask = 0xffffffffffffffff
+	weights = []
+	for i in range(seed, seed + count):
+		z = ((i + 1) * 0x9e3779b97f4a7c15) & mask
+		z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & mask
+		z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & mask
+		weights.append((z ^ (z >> 31)) | 1)
+	return numpy.array(weights, numpy.uint64)
+
+def _block_hashes(pixels, tile_size):
+	"""Hash every tile_size square of a (height, width, channels) pixel array,
+	as a (height - tile_size + 1, width - tile_size + 1) array indexed by the
+	square's top left corner."""
+	height, width, channels = pixels.shape
+	packed = numpy.zeros((height, width), numpy.uint64)
+	for channel in range(channels):
+		packed <<= numpy.uint64(8)
+		packed |= pixels[:, :, channel]
+	packed *= numpy.uint64(0xff51afd7ed558ccd)
+	packed ^= packed >> numpy.uint64(33)
+
+	span_x = width - tile_size + 1
+	span_y = height - tile_size + 1
+	rows = numpy.zeros((height, span_x), numpy.uint64)
+	for i, weight in enumerate(_hash_weights(tile_size, 0)):
+		rows += packed[:, i:i + span_x] * weight
+	blocks = numpy.zeros((span_y, span_x), numpy.uint64)
+	for i, weight in enumerate(_hash_weights(tile_size, tile_size)):
+		blocks += rows[i:i + span_y] * weight
+	return blocks
+
+def grid_sample_bands(width, height, tile_size=12, max_pixels=None):
+	"""The (top, bottom) rows of the bands of an image to find its grid from.
+
+	That's the whole image, unless it has more than max_pixels. Then it's
+	bands spread evenly down it, about max_pixels together, each just tall
+	enough to hold every vertical phase of the grid once."""
+	band = 2 * tile_size - 1
+	if not max_pixels or width * height <= max_pixels or height <= band:
+		return [(0, height)]
+	count = max(1, min(max_pixels // (width * band), height // band))
+	if count == 1:
+		top = (height - band) // 2
+		return [(top, top + band)]
+	return [(top, top + band) for top in
+			(i * (height - band) // (count - 1) for i in range(count))]
+
+def find_grid_phase(img, tile_size=12, max_pixels=GRID_SAMPLE_PIXELS):
+	"""Find the (dx, dy) offset of the tile grid in an image.
+
+	Every tile_size square of the image is hashed at once with a separable
+	rolling hash, then each of the tile_size ** 2 candidate phases is scored
+	by how many of its tiles are unique. The grid lining up with the real
+	tiles is the one that repeats the most. Without NumPy the grid is assumed
+	to start at the upper left corner.
+
+	Hashing takes several 64-bit words per pixel, so images of more than
+	max_pixels are only hashed in bands sampled down them, see
+	grid_sample_bands. max_pixels None hashes the whole image.
+	"""
+	if numpy is None:
+		return 0, 0
+
+	width, height = img.size
+	if width < tile_size or height < tile_size:
+		return 0, 0
+
+	# The squares of every band starting on each phase, by phase.
+	phases = {}
+	for top, bottom in grid_sample_bands(width, height, tile_size, max_pixels):
+		if (top, bottom) == (0, height):
+			band = img
+		else:
+			band = img.crop((0, top, width, bottom))
+		blocks = _block_hashes(image_pixels(band), tile_size)
+		for dy in range(0, tile_size):
+			rows = blocks[(dy - top) % tile_size::tile_size]
+			for dx in range(0, tile_size):
+				phases.setdefault((dx, dy), []).append(rows[:, dx::tile_size])
+
+	best = None
+	for dy in range(0, tile_size):
+		for dx in range(0, tile_size):
+			grids = phases[dx, dy]
+			if len(grids) == 1:
+				grid = grids[0]
+			else:
+				grid = numpy.concatenate([grid.ravel() for grid in grids])
+			if not grid.size:
+				# The phase leaves no whole tile in an image under two tiles
+				continue
+			score = len(numpy.unique(grid)) / float(grid.size)
+			if best is None or score < best[0]:
+				best = score, dx, dy
+	return best[1:]
+
+def align_to_grid(img, tile_size=12, max_pixels=GRID_SAMPLE_PIXELS):
+	"""Crop an image down to the whole tiles of its detected grid, returns the
+	cropped image and the (dx, dy) the grid starts at. max_pixels bounds the
+	memory finding the grid takes, see find_grid_phase."""
+	dx, dy = find_grid_phase(img, tile_size, max_pixels)
+	width, height = img.size
+	columns = (width - dx) // tile_size
+	rows = (height - dy) // tile_size
+
+	box = (dx, dy, dx + columns * tile_size, dy + rows * tile_size)
+	if box == (0, 0, width, height):
+		return img, (dx, dy)
+	logging.info("Aligned grid at %d,%d, cropped to %r" % (dx, dy, box))
+	return img.crop(box), (dx, dy)
+
+def scrape_source(uri, tile_size=12, stream=False, align=False,
+		known=frozenset(), tilemap=False, symmetric=False, cache=None):
+	"""Decode one source image and find its unique tiles.
+
+	Returns (digest, payload) pairs sorted by digest, leaving out any tile
+	whose digest is in known. Payloads are the raw pixel bytes of each tile,
+	see tti_tools.tile_from_bytes.
+
+	With tilemap it returns a (found, grid) pair instead, where grid is an
+	(origin, columns, digests, cells, transforms) tuple locating every whole
+	tile of the image: origin is the (x, y) the tile grid starts at and cells
+	indexes each grid cell, row by row, into digests. With symmetric, tiles
+	are canonicalized over their rotations and reflections and transforms is
+	the tti_tools.DIHEDRAL transform of each cell, otherwise it is None.
+
+	Given a tti_cache.TileCache, images scraped before with the same options
+	are read back from it instead, and the rest are added to it.
+	"""
+	profile = inkex.profile
+	key = entry = None
+	if cache is not None:
+		with profile.phase('cache'):
+			key = cache.key(uri, tile_size, align, symmetric, stream)
+			if key is not None:
+				entry = cache.get(key, tilemap)
+		profile.count('cache_misses' if entry is None else 'cache_hits')
+
+	if entry is not None:
+		digests, payloads, cached_grid = entry
+		if tilemap:
+			origin, columns, cells, transforms = cached_grid
+	else:
+		with profile.phase('decode'):
+			img = Image.open(decode_uri(uri))
+			img.load()
+		origin = (0, 0)
+		if align:
+			with profile.phase('align'):
+				img, origin = align_to_grid(img, tile_size)
+		columns = img.size[0] // tile_size
+		profile.count('images_scanned')
+		profile.count('tiles_scanned', columns * (img.size[1] // tile_size))
+
+		with profile.phase('hash'):
+			if tilemap:
+				payloads, cells, transforms = get_tile_grid(img, tile_size, stream,
+						symmetric)
+				if numpy is not None:
+					cells = list(cells)
+					if transforms is not None:
+						transforms = list(transforms)
+			else:
+				payloads = list(get_unique_payloads(img, tile_size, stream,
+						symmetric))
+			digests = [tti_tools.tile_digest(payload) for payload in payloads]
+
+		if key is not None:
+			with profile.phase('cache'):
+				cache.put(key, digests, payloads,
+						(origin, columns, cells, transforms) if tilemap else None)
+
+	found = [(digest, payload) for digest, payload in zip(digests, payloads)
+			if digest not in known]
+	found.sort()
+
+	if tilemap:
+		return found, (origin, columns, digests, cells, transforms)
+	return found
+
+class DigestClaims(object):
+	"""The digests of the tiles whose payloads a worker process has sent back,
+	held in a manager process and shared by all the workers."""
+
+	def __init__(self, known=()):
+		self.seen = set(known)
+
+	def claim(self, digests):
+		"Mark digests as seen, returns those no worker had claimed before."
+		new = [digest for digest in digests if digest not in self.seen]
+		self.seen.update(new)
+		return new
+
+class _ClaimsManager(multiprocessing.managers.BaseManager):
+	pass
+
+_ClaimsManager.register('DigestClaims', DigestClaims)
+
+_known_digests = frozenset()
+_claims = None
+
+def _init_worker(known, claims):
+	global _known_digests, _claims
+	_known_digests = known
+	_claims = claims
+
+def _scrape_worker(job):
+	"""Scrape one source image in a worker process. Only the payloads of tiles
+	no worker has claimed yet are sent back, the rest are None."""
+	index, (uri, tile_size, stream, align, tilemap, symmetric, cache) = job
+	result = scrape_source(uri, tile_size, stream, align, _known_digests,
+			tilemap, symmetric, cache)
+	found = result[0] if tilemap else result
+	claimed = set(_claims.claim([digest for digest, payload in found]))
+	found = [(digest, payload if digest in claimed else None)
+			for digest, payload in found]
+	return index, ((found, result[1]) if tilemap else found)
+
+def _fill_payloads(found, payloads):
+	"found with its payloads filled in, None while some aren't in payloads."
+	filled = []
+	for digest, payload in found:
+		if payload is None:
+			payload = payloads.get(digest)
+			if payload is None:
+				return None
+		filled.append((digest, payload))
+	return filled
+
+def scrape_sources(uris, tile_size=12, stream=False, align=False,
+		known=frozenset(), processes=1, grids=None, symmetric=False,
+		cache=None):
+	"""Scrape every source image, across a pool of worker processes if asked.
+
+	Returns (digest, payload) pairs for every tile not in known, ordered by
+	the first image each tile was found in and then by digest, so the result
+	is the same however many processes are used. A processes of 0 uses one
+	per core. If a grids list is given the tile grid of every image, as
+	described in scrape_source, is appended to it in order. symmetric treats
+	rotated and mirrored copies of a tile as the same tile. A cache, see
+	scrape_source, spares rescraping images that haven't changed.
+	"""
+	known = frozenset(known)
+	tilemap = grids is not None
+	results = iter_scraped(uris, tile_size, stream, align, known, processes,
+			tilemap, symmetric, cache)
+	if tilemap:
+		results = split_grids(results, grids)
+	return merge_scraped(results, known)
+
+def iter_scraped(uris, tile_size=12, stream=False, align=False,
+		known=frozenset(), processes=1, tilemap=False, symmetric=False,
+		cache=None):
+	"""Yield the scrape_source result of every source image in order, as soon
+	as it is ready, scraping across a pool of worker processes if asked.
+
+	Workers claim the digests they find through a DigestClaims, so each new
+	tile's payload is only sent back by the first worker to find it."""
+	known = frozenset(known)
+	if processes == 1:
+		for uri in uris:
+			yield scrape_source(uri, tile_size, stream, align, known,
+					tilemap, symmetric, cache)
+		return
+
+	jobs = [(uri, tile_size, stream, align, tilemap, symmetric, cache)
+			for uri in uris]
+	manager = _ClaimsManager()
+	manager.start()
+	pool = None
+	try:
+		claims = manager.DigestClaims(known)
+		pool = multiprocessing.Pool(processes or None, _init_worker, (known, claims))
+
+		# Results come back in any order and a tile's payload comes with
+		# whichever image claimed it first, so each result is held until
+		# those before it and the payloads it left out are in.
+		pending = {}
+		payloads = {}
+		next_index = 0
+		for index, result in pool.imap_unordered(_scrape_worker, enumerate(jobs)):
+			for digest, payload in (result[0] if tilemap else result):
+				if payload is not None:
+					payloads[digest] = payload
+			pending[index] = result
+			while next_index in pending:
+				result = pending[next_index]
+				found = _fill_payloads(result[0] if tilemap else result, payloads)
+				if found is None:
+					break
+				del pending[next_index]
+				next_index += 1
+				yield (found, result[1]) if tilemap else found
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+		manager.shutdown()
+
+def split_grids(results, grids):
+	"Pass on the found tiles of each result, collecting the grids."
+	for found, grid in results:
+		grids.append(grid)
+		yield found
+
+def merge_scraped(results, known=frozenset()):
+	"Merge per image scrape results in order, dropping repeated digests."
+	seen = set(known)
+	tiles = []
+	for found in results:
+		for digest, tile in found:
+			if digest not in seen:
+				seen.add(digest)
+				tiles.append((digest, tile))
+	inkex.profile.count('unique_tiles', len(tiles))
+	logging.info("Found %d new tiles" % len(tiles))
+	return tiles
+
+def tile_image(tile, tile_size=12):
+	"Rebuild a tile image from its pixel tuples."
+	img = Image.new('RGB', (tile_size, tile_size))
+	img.putdata(tile)
+	return img
+
+def write_atlas(path, images, rects, tile_size=12, width=0, padding=0, extrude=0):
+	"""Pack tile images into a sheet and save it as a PNG at path, with a JSON
+	map beside it of where each is.
+
+	rects are dicts describing each image (digest, slot, width and height),
+	their x and y are set to where the image was packed. A width of 0 packs
+	into the smallest power of two sheet."""
+	size, positions = tti_pack.pack([img.size for img in images],
+			width = width,
+			padding = padding,
+			extrude = extrude,
+			power_of_two = not width)
+	sheet = tti_pack.compose_sheet(images, size, positions, extrude, mode = 'RGB')
+	for rect, (x, y) in zip(rects, positions):
+		rect['x'], rect['y'] = x, y
+
+	sheet.save(path, 'png')
+	atlas_map = {
+		'image': os.path.basename(path),
+		'width': size[0],
+		'height': size[1],
+		'tile_size': tile_size,
+		'padding': padding,
+		'extrude': extrude,
+		'tiles': rects,
+	}
+	with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+		json.dump(atlas_map, f, indent = 1, separators = (',', ': '), sort_keys = True)
+
+def connected_components(count, sources, targets):
+	"""Label count nodes joined by the edges sources[i] -- targets[i] with the
+	lowest node of their connected component, by propagating the lowest label
+	across every edge and jumping pointers until nothing changes."""
+	labels = numpy.arange(count)
+	while True:
+		lowest = numpy.minimum(labels[sources], labels[targets])
+		merged = labels.copy()
+		numpy.minimum.at(merged, sources, lowest)
+		numpy.minimum.at(merged, targets, lowest)
+		merged = merged[merged]
+		if (merged == labels).all():
+			return labels
+		labels = merged
+
+def tile_features(data, tile_size):
+	"Average each channel over the quadrants of every tile in an array."
+	middle = max(tile_size // 2, 1)
+	halves = [half for half in (slice(0, middle), slice(middle, tile_size))
+			if half.start < tile_size]
+	return numpy.concatenate([data[:, rows, columns].mean(axis=1).mean(axis=1)
+			for rows in halves for columns in halves], axis=1)
+
+def cluster_tiles(tiles, tile_size=12, tolerance=8, tables=8, aliases=None,
+		known=()):
+	"""Group near duplicate tiles and keep one representative of each group.
+
+	tiles are (digest, payload) pairs as returned by scrape_sources. Two
+	tiles are near duplicates when no channel of any pixel differs by more
+	than tolerance. Rather than comparing every pair, the quadrant averages
+	of each tile are quantized with a random offset into a few hash tables,
+	and a tile is only checked against the first tile of each bucket it lands
+	in. Linked tiles are then split into clusters whose members are all within
+	tolerance of the cluster's representative, the member closest to the per
+	pixel median that is, in the order the clusters were first seen. Tiles
+	with and without alpha are never clustered together. If given, aliases
+	is filled with the digest of each dropped tile mapped to the digest of its
+	representative.
+
+	known are the (digest, payload) pairs of tiles already placed. Each is a
+	cluster of its own that new tiles near it join, with it as the
+	representative, and only the representatives of the other clusters are
+	returned.
+	"""
+	if numpy is None or tolerance <= 0 or not tiles or len(tiles) + len(known) < 2:
+		return tiles
+
+	# Tiles of each channel count are clustered on their own, known tiles
+	# first.
+	everything = list(known) + list(tiles)
+	groups = {}
+	for i, (digest, payload) in enumerate(everything):
+		groups.setdefault(len(payload), []).append(i)
+
+	clusters = []
+	for indices in groups.itervalues():
+		payloads = [everything[i][1] for i in indices]
+		fixed = sum(1 for i in indices if i < len(known))
+		for members, best in _cluster_payloads(payloads, tile_size, tolerance,
+				tables, fixed):
+			clusters.append((indices[members[0]], indices[best],
+					[indices[member] for member in members]))
+	clusters.sort()
+
+	clustered = []
+	for first, best, members in clusters:
+		if best >= len(known):
+			clustered.append(everything[best])
+		if aliases is not None:
+			for member in members:
+				if member != best:
+					aliases[everything[member][0]] = everything[best][0]
+
+	logging.info("Clustered %d tiles into %d new ones" % (len(tiles), len(clustered)))
+	return clustered
+
+def _cluster_payloads(payloads, tile_size, tolerance, tables, fixed=0):
+	"""Cluster payloads of one size for cluster_tiles, yields the members of
+	each cluster, first seen first, and its representative as indexes into
+	payloads. The first fixed payloads each start a cluster they represent."""
+	count = len(payloads)
+	data = numpy.frombuffer(''.join(payloads),
+			numpy.uint8).reshape(count, tile_size, tile_size, -1)
+	flat = data.reshape(count, -1).astype(numpy.int16)
+	if count < 2:
+		for i in range(count):
+			yield [i], i
+		return
+
+	# Bucket every tile in each table, then link it to the first tile of its
+	# bucket when the two are within tolerance.
+	features = tile_features(data, tile_size)
+	width = 4.0 * tolerance
+	offsets = numpy.random.RandomState(0).uniform(0, width,
+			(tables, features.shape[1]))
+	weights = _hash_weights(features.shape[1], 0)
+	sources = []
+	targets = []
+	for offset in offsets:
+		cells = numpy.floor((features + offset) / width).astype(numpy.int64)
+		keys = (cells.view(numpy.uint64) * weights).sum(axis=1)
+		order = numpy.argsort(keys, kind='mergesort')
+		starts = numpy.r_[True, keys[order][1:] != keys[order][:-1]]
+		heads = order[starts][numpy.cumsum(starts) - 1]
+
+		near = numpy.abs(flat[order] - flat[heads]).max(axis=1) <= tolerance
+		sources.append(order[near])
+		targets.append(heads[near])
+	sources = numpy.concatenate(sources)
+	targets = numpy.concatenate(targets)
+
+	# Each group of linked tiles is labelled with its first tile.
+	labels = connected_components(count, sources, targets)
+
+	order = numpy.argsort(labels, kind='mergesort')
+	starts = numpy.flatnonzero(numpy.diff(labels[order])) + 1
+	for linked in numpy.split(order, starts):
+		if len(linked) == 1:
+			yield [linked[0]], linked[0]
+			continue
+		# A chain of links can drift further than tolerance, so each tile
+		# joins the first cluster whose first tile it's within tolerance of.
+		seeds = []
+		clusters = []
+		for member in linked:
+			if seeds and member >= fixed:
+				near = numpy.abs(flat[seeds] - flat[member]).max(axis=1) <= tolerance
+				if near.any():
+					clusters[near.argmax()].append(member)
+					continue
+			seeds.append(member)
+			clusters.append([member])
+		for members in clusters:
+			if members[0] < fixed:
+				yield members, members[0]
+			else:
+				yield members, _cluster_representative(flat, members, tolerance)
+
+def _cluster_representative(flat, members, tolerance):
+	"""The member closest to the per pixel median of a cluster that is within
+	tolerance of every other member. The first member always is."""
+	if len(members) == 1:
+		return members[0]
+	pixels = flat[members]
+	median = numpy.median(pixels, axis=0)
+	for i in numpy.abs(pixels - median).sum(axis=1).argsort(kind='mergesort'):
+		if numpy.abs(pixels - pixels[i]).max() <= tolerance:
+			return members[i]
+	return members[0]
+
 class ScrapeTiles(inkex.Effect):
 	def __init__(self):
 		inkex.Effect.__init__(self)
+		self.lazy_payloads = True
+		self.fragments = tti_tools.Fragments()
 
 		self.OptionParser.add_option('-s', '--size',
 						action = 'store', type = 'int',
@@ -109,6 +841,106 @@ class ScrapeTiles(inkex.Effect):
 						dest = 'group', default = True,
 						help = 'Group like colors into paths?')
 
+		self.OptionParser.add_option('-e', '--merge',
+						action = 'store', type = 'inkbool',
+						dest = 'merge', default = True,
+						help = 'Merge like colored pixels into rectangles?')
+
+		self.OptionParser.add_option('-i', '--instance',
+						action = 'store', type = 'inkbool',
+						dest = 'instance', default = False,
+						help = 'Share repeated vector tiles through symbols?')
+
+		self.OptionParser.add_option('-l', '--palette',
+						action = 'store', type = 'inkbool',
+						dest = 'palette', default = False,
+						help = 'Embed raster tiles as palette PNGs sharing one palette?')
+
+		self.OptionParser.add_option('-x', '--atlas',
+						action = 'store', type = 'inkbool',
+						dest = 'atlas', default = False,
+						help = 'Show raster tiles through one atlas image?')
+
+		self.OptionParser.add_option('-o', '--atlas-file',
+						action = 'store', type = 'string',
+						dest = 'atlas_file', default = '',
+						help = 'Also save the atlas as this PNG, with a JSON map of its tiles beside it')
+
+		self.OptionParser.add_option('-w', '--atlas-width',
+						action = 'store', type = 'int',
+						dest = 'atlas_width', default = 0,
+						help = 'Width of the saved atlas (0 for the smallest power of two sheet)')
+
+		self.OptionParser.add_option('-d', '--atlas-padding',
+						action = 'store', type = 'int',
+						dest = 'atlas_padding', default = 0,
+						help = 'Pixels left clear between tiles in the saved atlas')
+
+		self.OptionParser.add_option('-r', '--atlas-extrude',
+						action = 'store', type = 'int',
+						dest = 'atlas_extrude', default = 0,
+						help = 'Pixels each tile\'s edges are repeated outwards in the saved atlas')
+
+		self.OptionParser.add_option('-a', '--align',
+						action = 'store', type = 'inkbool',
+						dest = 'align', default = True,
+						help = 'Find the tile grid in screenshots that are not cropped to it?')
+
+		self.OptionParser.add_option('-t', '--tolerance',
+						action = 'store', type = 'int',
+						dest = 'tolerance', default = 0,
+						help = 'How many color levels apart can pixels of the same tile be?')
+
+		self.OptionParser.add_option('-p', '--tilemap',
+						action = 'store', type = 'inkbool',
+						dest = 'tilemap', default = False,
+						help = 'Record which tile is where in each screenshot?')
+
+		self.OptionParser.add_option('-y', '--symmetry',
+						action = 'store', type = 'inkbool',
+						dest = 'symmetric', default = False,
+						help = 'Treat rotated and mirrored copies of a tile as the same tile?')
+
+		self.OptionParser.add_option('-m', '--stream',
+						action = 'store', type = 'inkbool',
+						dest = 'stream', default = False,
+						help = 'Read screenshots a row of tiles at a time?')
+
+		self.OptionParser.add_option('-j', '--jobs',
+						action = 'store', type = 'int',
+						dest = 'jobs', default = 1,
+						help = 'How many processes to scrape with? (0 for one per core)')
+
+		self.OptionParser.add_option('-k', '--skip',
+						action = 'store', type = 'inkbool',
+						dest = 'skip_known', default = True,
+						help = 'Skip tiles already on the Tileset Layers?')
+
+		self.OptionParser.add_option('-u', '--cache',
+						action = 'store', type = 'inkbool',
+						dest = 'cache', default = True,
+						help = 'Keep what each screenshot holds on disk, to only rescrape changed ones?')
+
+		self.OptionParser.add_option('--cache-dir',
+						action = 'store', type = 'string',
+						dest = 'cache_dir', default = '',
+						help = 'Where to keep the cache (empty for the user cache directory)')
+
+		self.OptionParser.add_option('--cache-size',
+						action = 'store', type = 'int',
+						dest = 'cache_size', default = 256,
+						help = 'How many megabytes the cache can grow to')
+
+	def open_cache(self):
+		"The TileCache to scrape through, None if it's off or can't be made."
+		if not self.options.cache or self.options.cache_size <= 0:
+			return None
+		path = self.options.cache_dir or tti_cache.default_cache_dir()
+		try:
+			return tti_cache.TileCache(path, self.options.cache_size << 20)
+		except OSError, e:
+			logging.warning("Not caching, can't make %s: %s" % (path, e))
+			return None
 
 	def effect(self):
 		self.tile_size = tile_size = self.options.tile_size
@@ -122,58 +954,191 @@ class ScrapeTiles(inkex.Effect):
 
 		columns = width // tile_size
 
+		set_layers = self.getLayersByLabel('Tileset Layer')
+
 		if clear_first:
-			set_layer_path = '//svg:g[@inkscape:label="Tileset Layer"]'
-			set_layer = root.xpath(set_layer_path, namespaces=inkex.NSS)
-			for layer in set_layer:
-				root.remove(layer)
+			for layer in set_layers:
+				self.removeNode(layer)
+			set_layers = []
+
+		index = tti_tools.TileIndex(columns, tile_size)
+		if self.options.skip_known and set_layers:
+			for layer in set_layers:
+				index.add_layer(layer)
+			set_layer = set_layers[-1]
+		else:
+			set_layer = inkex.etree.SubElement(root, 'g')
+			set_layer.set(inkex.addNS('label', 'inkscape'), 'Tileset Layer')
+			set_layer.set(inkex.addNS('groupmode', 'inkscape'), 'layer')
+			self.indexNode(set_layer)
+		logging.info("%d tiles already indexed" % len(index))
 
-		set_layer = inkex.etree.SubElement(root, 'g')
-		set_layer.set(inkex.addNS('label', 'inkscape'), 'Tileset Layer')
-		set_layer.set(inkex.addNS('groupmode', 'inkscape'), 'layer')
+		sources = list(self.gather_sources())
+		cache = self.open_cache()
+		if self.options.tilemap:
+			grids = []
+		else:
+			grids = None
 
+		with inkex.profile.phase('scrape'):
+			tiles = scrape_sources(
+				[inkex.getHref(source) for source in sources],
+				tile_size,
+				stream = self.options.stream,
+				align = self.options.align,
+				known = index.known(),
+				processes = self.options.jobs,
+				grids = grids,
+				symmetric = self.options.symmetric,
+				cache = cache
+			)
+		if cache is not None:
+			cache.trim()
+		aliases = {}
+		if self.options.tolerance and tiles:
+			with inkex.profile.phase('cluster'):
+				# New tiles near one already placed become its aliases.
+				known_tiles = index.payloads(
+						tti_tools.VectorTiles(tile_size, self.getElementById))
+				tiles = cluster_tiles(tiles, tile_size, self.options.tolerance,
+						aliases = aliases, known = known_tiles)
 
-		tiles = set()
-		for uri in self.gather_source_uris():
-			tiles |= get_unique_tiles(Image.open(decode_uri(uri)), tile_size)
+		if vectorize and self.options.instance:
+			symbols = tti_tools.TileSymbols(self.document, tile_size)
 
-		if vectorize:
-			for i, tile in enumerate(tiles):
-				pos = tti_tools.index2pos(columns, i, scale=tile_size)
+		if self.options.atlas and not vectorize:
+			atlas = tti_tools.TileAtlas(self.document, set_layer, columns, tile_size,
+					self.uniqueId)
+		else:
+			atlas = None
 
-				any_img = tti_tools.AnyImage(tile_size, pos, tile)
+		self.palette_index = None
+		if self.options.palette and not vectorize:
+			palette = tti_tools.build_palette(
+				(tti_tools.tile_from_bytes(payload, tile_size) for digest, payload in tiles),
+				tti_tools.get_palette(set_layer))
+			tti_tools.set_palette(set_layer, palette)
+			self.palette_index = dict((color, i) for i, color in enumerate(palette))
 
-				if self.options.group:
-					vector_tile = any_img.vectorize_with_paths()
-				else:
-					vector_tile = any_img.vectorize()
+		for digest, payload in tiles:
+			tile = tti_tools.tile_from_bytes(payload, tile_size)
+			slot = index.next_slot()
+			pos = tti_tools.index2pos(columns, slot, scale=tile_size)
 
-				set_layer.append(vector_tile)
-		else:
-			tiles = [self.rebuild_tile(tile) for tile in tiles]
-			for i, tile in enumerate(tiles):
-				uri = make_data_uri(tile)
-				img = self.build_svg_img(
-					uri,
-					x = str((i % columns) * tile_size),
-					y = str((i // columns) * tile_size),
+			if vectorize and self.options.instance:
+				tile_element = symbols.use(digest, pos, lambda: self.build_vector_tile(
+						tti_tools.AnyImage(tile_size, (0, 0), tile)))
+			elif vectorize:
+				any_img = tti_tools.AnyImage(tile_size, pos, tile)
+				tile_element = self.build_vector_tile(any_img)
+			elif atlas is not None:
+				tile_element = atlas.tile(pos, self.rebuild_tile(tile))
+			else:
+				tile_element = self.build_svg_img(
+					self.tile_uri(tile),
+					x = str(pos[0]),
+					y = str(pos[1]),
 					width = str(tile_size),
 					height = str(tile_size)
 				)
-				set_layer.append(img)
+
+			index.add(tile_element, digest, slot)
+			set_layer.append(tile_element)
+
+		merged = {}
+		for alias, digest in aliases.iteritems():
+			merged.setdefault(digest, []).append(alias)
+		for digest, merged_aliases in merged.iteritems():
+			index.add_aliases(digest, sorted(merged_aliases))
+
+		if atlas is not None and atlas.empty():
+			logging.warning("No tiles to show through an atlas")
+		elif atlas is not None:
+			with inkex.profile.phase('atlas'):
+				atlas_img = atlas.update()
+				if self.options.atlas_file:
+					self.save_atlas(atlas_img, atlas.tile_rects(set_layer))
+
+		if grids is not None:
+			with inkex.profile.phase('tilemap'):
+				self.record_tilemaps(sources, grids, index)
+
+	def save_atlas(self, atlas_img, rects):
+		"""Pack the atlas's tiles into a sheet and write it with a JSON map of
+		where each tile is in it."""
+		if not rects:
+			logging.warning("No tiles on the atlas to save")
+			return
+		images = [atlas_img.crop((rect['x'], rect['y'],
+				rect['x'] + rect['width'], rect['y'] + rect['height'])) for rect in rects]
+		write_atlas(self.options.atlas_file, images, rects, self.tile_size,
+				self.options.atlas_width, self.options.atlas_padding,
+				self.options.atlas_extrude)
+
+	def record_tilemaps(self, sources, grids, index):
+		"""Store a packed map of tile slots on each source image and the number
+		of times each tile was seen on the tiles themselves. Cells of merged
+		near duplicates map to the tile they were merged into."""
+		counts = dict.fromkeys(index.digests, 0)
+		for source, grid in zip(sources, grids):
+			origin, columns, digests, cells, transforms = grid
+			digests = [index.aliases.get(digest, digest) for digest in digests]
+			slots = [index.slot(digest) for digest in digests]
+			for i in cells:
+				counts[digests[i]] += 1
+
+			tti_tools.set_tilemap(source, [slots[i] for i in cells],
+					columns, origin, self.tile_size, transforms)
+
+		for digest, count in counts.iteritems():
+			index.digests[digest].set(inkex.addNS('count', 'tti'), str(count))
+
+	def gather_sources(self):
+		image = inkex.addNS('image', 'svg')
+		return [source for layer in self.getLayersByLabel('Source Layer')
+				for source in layer.iterchildren(image)]
 
 	def gather_source_uris(self):
-		path = '//svg:g[@inkscape:label="Source Layer"]/svg:image'
-		source_elements = self.document.xpath(path, namespaces=inkex.NSS)
+		for element in self.gather_sources():
+			yield inkex.getHref(element)
+
+	def tile_uri(self, tile):
+		"""Embed a tile as a PNG, a palette one when the shared palette is in
+		use and the tile is RGB. An 8 bit palette PNG is only used if it comes
+		out smaller than the full color one."""
+		with inkex.profile.phase('encode'):
+			paletted = None
+			if self.palette_index is not None:
+				paletted = tti_tools.palette_image(tile, self.tile_size, self.palette_index)
+			if paletted is None:
+				return make_data_uri(self.rebuild_tile(tile))
 
-		for element in source_elements:
-			yield element.attrib[inkex.addNS('href', 'xlink')]
+			img, bits = paletted
+			uri = make_data_uri(img, bits = bits, optimize = True)
+			# Below 8 bits the palette PNG is nearly always the smaller, so
+			# the full color one is only worth encoding to compare with an
+			# 8 bit one.
+			if bits == 8:
+				full_uri = make_data_uri(self.rebuild_tile(tile))
+				if len(full_uri) < len(uri):
+					uri = full_uri
+		return uri
 
 	def rebuild_tile(self, tile_tuple):
 		"Rebuild a tile image from it's pixel tuples"
-		tile_img = Image.new('RGB', (self.tile_size, self.tile_size))
-		tile_img.putdata(tile_tuple)
-		return tile_img
+		return tile_image(tile_tuple, self.tile_size)
+
+	def output(self):
+		self.fragments.write(self.document, sys.stdout)
+
+	def build_vector_tile(self, any_img):
+		tile_group = inkex.etree.Element(inkex.addNS('g', 'svg'))
+		with inkex.profile.phase('vectorize'):
+			if self.options.group:
+				markup = any_img.vectorize_with_paths_markup(self.options.merge)
+			else:
+				markup = any_img.vectorize_markup(self.options.merge)
+		return self.fragments.attach(tile_group, markup)
 
 	def build_svg_img(self, uri, **attrs):
 		img = inkex.etree.Element(inkex.addNS('image', 'svg'), attrs)
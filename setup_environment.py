@@ -2,9 +2,6 @@
 import logging
 import itertools
 import sys
-import urllib
-
-from cStringIO import StringIO
 
 import inkex
 import simplestyle
@@ -19,20 +16,6 @@ logging.basicConfig(
 def rgb2hex(rgb):
 	return "#%02X%02X%02X" % rgb
 
-def make_data_uri(img):
-	"Convert an Image to a base64 URI"
-	s = StringIO()
-	img.save(s, 'png')
-	s.seek(0)
-	img_s = ''.join(s.readlines()).encode('base64').translate(None, '\n')
-	return "data:image/png;base64,%s" % img_s
-
-def decode_uri(uri):
-	"Scrap a URI which suitable to pass to Image.open()"
-	if uri.startswith("file:///"):
-		return urllib.unquote(uri[len("file:///"):])
-	return StringIO(uri[uri.find("base64,") + len("base64,"):].decode('base64'))
-
 def get_unique_tiles_slowly(img, size=12):
 	logging.info("Gathering unique tiles...")
 	tiles = set()
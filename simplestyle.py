@@ -21,6 +21,36 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 """
 
+def memoize(maxsize=256):
+    """Decorator caching a one argument function on its argument
+
+    Holds at most 2 * maxsize results, least recently used first out: new
+    results go into a young generation, and when that fills up it replaces
+    the old one.  A hit in the old generation is promoted back.  The
+    undecorated function stays reachable as .uncached."""
+    def decorate(func):
+        generations = [{}, {}]
+        def cached(arg):
+            young, old = generations
+            try:
+                return young[arg]
+            except KeyError:
+                pass
+            try:
+                value = old[arg]
+            except KeyError:
+                value = func(arg)
+            if len(young) >= maxsize:
+                old, young = young, {}
+                generations[:] = young, old
+            young[arg] = value
+            return value
+        cached.uncached = func
+        cached.__name__ = func.__name__
+        cached.__doc__ = func.__doc__
+        return cached
+    return decorate
+
 svgcolors={
     'aliceblue':'#f0f8ff',
     'antiquewhite':'#faebd7',
@@ -171,12 +201,16 @@ svgcolors={
     'yellowgreen':'#9acd32'
 }
 
+@memoize(1024)
+def _parseStyle(s):
+    return dict([i.split(":") for i in s.split(";") if len(i)])
+
 def parseStyle(s):
     """Create a dictionary from the value of an inline style attribute"""
     if s is None:
       return {}
     else:
-      return dict([i.split(":") for i in s.split(";") if len(i)])
+      return dict(_parseStyle(s))
 def formatStyle(a):
     """Format an inline style attribute from a dictionary"""
     return ";".join([att+":"+str(val) for att,val in a.iteritems()])
@@ -190,8 +224,11 @@ def isColor(c):
     #however, rgb() shouldnt occur at this point
     return False
 
+@memoize(1024)
 def parseColor(c):
     """Creates a rgb int array"""
+    if len(c) == 7 and c[0] == '#':
+        return (int(c[1:3],16), int(c[3:5],16), int(c[5:],16))
     tmp = svgcolors.get(c.lower())
     if tmp is not None:
         c = tmp
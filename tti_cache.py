@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+A cache on disk of what scraping each screenshot found, so a rescrape only
+decodes and dedups the screenshots that are new or have changed.
+
+Entries are keyed by the screenshot and the scrape options that change what
+is found. A file:/// link is taken as unchanged while its path, size and
+modification time are, an embedded screenshot is hashed. Each entry is one
+file holding the screenshot's unique tiles, digests and pixel payloads, and
+its tile grid if one was asked for, zlib compressed.
+
+Writers build an entry in a temporary file beside it and rename it into
+place, so several scrapes, or the processes of one, can share a cache and
+readers only ever see whole entries. Reading an entry touches it, and once
+the cache outgrows its size the least recently used entries are removed.
+"""
+import array
+import binascii
+import hashlib
+import logging
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+import inkex
+
+from tti_datauri import decode_uri
+
+MAGIC = 'TTIC'
+VERSION = 1
+SUFFIX = '.tti'
+
+# Magic, version, flags, payload size and tile count.
+HEADER = struct.Struct('<4sHHII')
+# Grid origin x and y, columns and cell count.
+GRID = struct.Struct('<iiII')
+
+HAS_GRID = 1
+HAS_TRANSFORMS = 2
+
+# Temporary files this old were left by a writer that died.
+STALE_SECONDS = 3600
+
+def default_cache_dir():
+	"Where the cache goes unless told otherwise."
+	base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+			os.path.expanduser('~'), '.cache')
+	return os.path.join(base, 'tilesettools')
+
+class _Hasher(object):
+	"Lets Payload.copy stream into a hash."
+	def __init__(self):
+		self.hash = hashlib.sha1()
+
+	def write(self, data):
+		self.hash.update(data)
+
+def source_hash(uri):
+	"""What identifies a screenshot's content, None if it can't be had.
+
+	uri is a data: or file:/// URI, or an inkex.Payload holding one."""
+	if isinstance(uri, inkex.Payload):
+		hasher = _Hasher()
+		if uri.escaped:
+			hasher.write(uri.read())
+		else:
+			uri.copy(hasher)
+		return 'data:' + hasher.hash.hexdigest()
+	if isinstance(uri, unicode):
+		uri = uri.encode('utf-8')
+	if uri.startswith('file:///'):
+		path = os.path.abspath(decode_uri(uri))
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		return 'file:%s:%d:%r' % (path, stat.st_size, stat.st_mtime)
+	return 'data:' + hashlib.sha1(uri).hexdigest()
+
+def _pack_array(typecode, values):
+	packed = array.array(typecode, values)
+	if sys.byteorder == 'big':
+		packed.byteswap()
+	return packed.tostring()
+
+def _unpack_array(typecode, data):
+	packed = array.array(typecode)
+	packed.fromstring(data)
+	if sys.byteorder == 'big':
+		packed.byteswap()
+	return packed.tolist()
+
+def pack_entry(digests, payloads, grid=None):
+	"""An entry's bytes: the tiles' hex digests and payloads, all one size,
+	and optionally the (origin, columns, cells, transforms) of the grid
+	indexing them."""
+	size = len(payloads[0]) if payloads else 0
+	flags = 0
+	body = [''.join(binascii.unhexlify(digest) for digest in digests)]
+	body.extend(payloads)
+	if grid is not None:
+		origin, columns, cells, transforms = grid
+		flags |= HAS_GRID
+		body.append(GRID.pack(origin[0], origin[1], columns, len(cells)))
+		body.append(_pack_array('I', cells))
+		if transforms is not None:
+			flags |= HAS_TRANSFORMS
+			body.append(_pack_array('B', transforms))
+	return HEADER.pack(MAGIC, VERSION, flags, size, len(payloads)) + \
+			zlib.compress(''.join(body), 1)
+
+def unpack_entry(data):
+	"""The (digests, payloads, grid) of an entry, grid None if it has none.
+	Raises ValueError if the entry is damaged or from another version."""
+	try:
+		magic, version, flags, size, count = HEADER.unpack_from(data)
+		body = zlib.decompress(buffer(data, HEADER.size))
+	except (struct.error, zlib.error), e:
+		raise ValueError("Damaged cache entry: %s" % e)
+	if magic != MAGIC or version != VERSION:
+		raise ValueError("Not a version %d cache entry" % VERSION)
+
+	end = count * (20 + size)
+	if len(body) < end:
+		raise ValueError("Truncated cache entry")
+	digests = [binascii.hexlify(body[i:i + 20]) for i in xrange(0, count * 20, 20)]
+	payloads = [body[i:i + size] for i in xrange(count * 20, end, size)] \
+			if size else [''] * count
+
+	grid = None
+	if flags & HAS_GRID:
+		try:
+			x, y, columns, cell_count = GRID.unpack_from(body, end)
+		except struct.error:
+			raise ValueError("Truncated cache entry")
+		start = end + GRID.size
+		end = start + cell_count * 4
+		cells = _unpack_array('I', body[start:end])
+		transforms = None
+		if flags & HAS_TRANSFORMS:
+			transforms = _unpack_array('B', body[end:end + cell_count])
+			end += cell_count
+		if len(cells) != cell_count or (transforms is not None and
+				len(transforms) != cell_count) or len(body) != end:
+			raise ValueError("Truncated cache entry")
+		grid = ((x, y), columns, cells, transforms)
+	elif len(body) != end:
+		raise ValueError("Truncated cache entry")
+	return digests, payloads, grid
+
+class TileCache(object):
+	"""A directory of scrape results bounded to max_bytes.
+
+	It's only a path and a size, so it can be handed to worker processes."""
+
+	def __init__(self, path, max_bytes=256 << 20):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.written = 0
+		if not os.path.isdir(path):
+			try:
+				os.makedirs(path)
+			except OSError:
+				# Made meanwhile by another process, or can't be.
+				if not os.path.isdir(path):
+					raise
+
+	def key(self, uri, *options):
+		"""The key of a screenshot scraped with options, None if it can't be
+		cached."""
+		source = source_hash(uri)
+		if source is None:
+			return None
+		options = ' '.join(repr(option) for option in options)
+		return hashlib.sha1('%d\0%s\0%s' % (VERSION, options, source)).hexdigest()
+
+	def entry_path(self, key):
+		return os.path.join(self.path, key + SUFFIX)
+
+	def get(self, key, need_grid=False):
+		"""The (digests, payloads, grid) cached under key, None if there are
+		none or need_grid and they were cached without a grid."""
+		path = self.entry_path(key)
+		try:
+			with open(path, 'rb') as f:
+				data = f.read()
+		except IOError:
+			return None
+		try:
+			entry = unpack_entry(data)
+		except ValueError, e:
+			logging.warning("Dropping %s: %s" % (path, e))
+			self._remove(path)
+			return None
+		if need_grid and entry[2] is None:
+			return None
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+		return entry
+
+	def put(self, key, digests, payloads, grid=None):
+		"""Cache the digests and payloads of tiles, and the (origin, columns,
+		cells, transforms) of their grid if given, under key. Failing to is
+		only logged."""
+		data = pack_entry(digests, payloads, grid)
+		try:
+			fd, temp = tempfile.mkstemp(prefix = '.', suffix = '.tmp', dir = self.path)
+		except OSError, e:
+			logging.warning("Can't write to the cache: %s" % e)
+			return
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(data)
+			os.rename(temp, self.entry_path(key))
+		except (IOError, OSError), e:
+			# Windows won't rename over an entry another writer just made.
+			self._remove(temp)
+			if not os.path.exists(self.entry_path(key)):
+				logging.warning("Can't write to the cache: %s" % e)
+			return
+
+		self.written += len(data)
+		if self.written > self.max_bytes // 8:
+			self.trim()
+
+	def trim(self):
+		"Remove the least recently used entries until the cache fits."
+		self.written = 0
+		entries = []
+		total = 0
+		now = time.time()
+		try:
+			names = os.listdir(self.path)
+		except OSError:
+			return
+		for name in names:
+			path = os.path.join(self.path, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			if name.endswith(SUFFIX):
+				entries.append((stat.st_mtime, stat.st_size, path))
+				total += stat.st_size
+			elif name.endswith('.tmp') and now - stat.st_mtime > STALE_SECONDS:
+				self._remove(path)
+
+		entries.sort()
+		for mtime, size, path in entries:
+			if total <= self.max_bytes:
+				break
+			self._remove(path)
+			total -= size
+			inkex.profile.count('cache_evictions')
+
+	def _remove(self, path):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
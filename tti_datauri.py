@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Reading and writing the data: URIs screenshots and tiles are embedded with.
+
+Screenshots can be several megabytes of base64, so neither direction slices
+or re-joins the payload: decoding reads straight out of a view of the href
+and hands PIL the decoded bytes without copying them again, encoding base64s
+the PNG as PIL writes it.
+"""
+import binascii
+import urllib
+
+from cStringIO import StringIO
+
+import inkex
+
+BASE64_MARKER = "base64,"
+PNG_PREFIX = "data:image/png;base64,"
+
+def payload_offset(uri):
+	"Where the base64 payload of a data URI starts."
+	return uri.find(BASE64_MARKER) + len(BASE64_MARKER)
+
+def decode_payload(uri):
+	"The decoded bytes of a base64 data URI."
+	if isinstance(uri, unicode):
+		uri = uri.encode('ascii')
+	data = binascii.a2b_base64(buffer(uri, payload_offset(uri)))
+	inkex.profile.count('bytes_decoded', len(data))
+	return data
+
+def decode_uri(uri):
+	"""Scrap a URI which suitable to pass to Image.open(), or an inkex.Payload
+	holding one."""
+	if isinstance(uri, inkex.Payload):
+		uri = uri.read()
+	if uri.startswith("file:///"):
+		# Keep the leading slash of the path, url2pathname drops it again
+		# before a Windows drive letter.
+		return urllib.url2pathname(uri[len("file://"):])
+	# An input cStringIO shares the string it wraps rather than copying it.
+	return StringIO(decode_payload(uri))
+
+def encode_image(img, format='png'):
+	"The bytes of an Image saved as format."
+	s = StringIO()
+	img.save(s, format)
+	return s.getvalue()
+
+class Base64Writer(object):
+	"""A write-only file that base64 encodes whatever is written to it.
+
+	PIL saves straight into it, so the encoded image is never held as raw
+	bytes as well.  Writes are encoded in multiples of 3 bytes and the
+	remainder carried over, which keeps the output free of padding until
+	getvalue() flushes the end."""
+
+	def __init__(self, prefix=''):
+		self.out = StringIO()
+		self.out.write(prefix)
+		self.pending = ''
+
+	def write(self, data):
+		if self.pending:
+			data = self.pending + data
+		whole = len(data) - len(data) % 3
+		if whole:
+			# b2a_base64 doesn't wrap lines, only appends a newline
+			self.out.write(binascii.b2a_base64(buffer(data, 0, whole))[:-1])
+		self.pending = data[whole:]
+
+	def flush(self):
+		pass
+
+	def getvalue(self):
+		if self.pending:
+			self.out.write(binascii.b2a_base64(self.pending)[:-1])
+			self.pending = ''
+		return self.out.getvalue()
+
+def make_data_uri(img, **params):
+	"Convert an Image to a base64 URI, params are passed on to the PNG encoder"
+	s = Base64Writer(PNG_PREFIX)
+	img.save(s, 'png', **params)
+	uri = s.getvalue()
+	inkex.profile.count('bytes_encoded', len(uri))
+	return uri
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Packing tiles and sprites of any size into one sheet.
+
+Rectangles are placed with a bottom-left skyline packer: the sheet's filled
+outline is kept as a list of horizontal segments, and each rectangle goes
+where its top edge ends up lowest, ties going to the left.  That is
+O(segments) per rectangle, and with the input sorted tallest first the
+outline stays short, so thousands of rectangles pack in well under a second.
+MaxRects packs a little tighter but keeps a free list that grows
+quadratically, which rules it out for re-packing on every scrape.
+"""
+from PIL import Image
+
+def next_power_of_two(n):
+	power = 1
+	while power < n:
+		power <<= 1
+	return power
+
+class Skyline(object):
+	"A sheet of fixed width and unbounded height, filled bottom-left."
+
+	def __init__(self, width):
+		self.width = width
+		self.height = 0
+		# The outline, segment i runs from xs[i] to xs[i + 1] at height ys[i].
+		self.xs = [0, width]
+		self.ys = [0]
+
+	def find(self, w, h):
+		"Where a w by h rectangle would go, as (segment, y), or None if it's too wide."
+		xs, ys = self.xs, self.ys
+		limit = self.width - w
+		best = None
+		best_top = None
+		segments = len(ys)
+		for i in xrange(segments):
+			x = xs[i]
+			if x > limit:
+				break
+			right = x + w
+			y = ys[i]
+			j = i + 1
+			while xs[j] < right:
+				if ys[j] > y:
+					y = ys[j]
+				j += 1
+			if best_top is None or y + h < best_top:
+				best = i, y
+				best_top = y + h
+		return best
+
+	def place(self, segment, y, w, h):
+		"Raise the outline over a rectangle placed at the start of segment."
+		xs, ys = self.xs, self.ys
+		x = xs[segment]
+		right = x + w
+		top = y + h
+		# Segments wholly under the rectangle are replaced by it, one
+		# overhanging its right edge is shortened.
+		k = segment
+		while k < len(ys) and xs[k + 1] <= right:
+			k += 1
+		if k < len(ys) and xs[k] < right:
+			xs[k] = right
+		xs[segment:k] = [x]
+		ys[segment:k] = [top]
+		# Merge with neighbours of the same height to keep the outline short.
+		if segment + 1 < len(ys) and ys[segment + 1] == top:
+			del xs[segment + 1]
+			del ys[segment + 1]
+		if segment > 0 and ys[segment - 1] == top:
+			del xs[segment]
+			del ys[segment]
+		if top > self.height:
+			self.height = top
+		return x, y
+
+	def insert(self, w, h):
+		"Place a w by h rectangle, returning its x, y or None if it's too wide."
+		found = self.find(w, h)
+		if found is None:
+			return None
+		return self.place(found[0], found[1], w, h)
+
+def packing_order(sizes):
+	"""The order to pack sizes in, tallest then widest first, ties kept in
+	input order so the same rectangles always pack the same way."""
+	return sorted(range(len(sizes)),
+			key = lambda i: (-sizes[i][1], -sizes[i][0], i))
+
+def pack_width(sizes, width, padding=0, extrude=0):
+	"""Pack (w, h) sizes into a sheet width pixels wide.
+
+	Each rectangle is grown by extrude on every side and keeps padding
+	pixels clear to its right and below.  Returns the sheet height and the
+	x, y of each rectangle's own pixels, in the order of sizes, or None if a
+	rectangle is wider than the sheet."""
+	grow = 2 * extrude + padding
+	sheet = Skyline(width + padding)
+	positions = [None] * len(sizes)
+	for i in packing_order(sizes):
+		w, h = sizes[i]
+		placed = sheet.insert(w + grow, h + grow)
+		if placed is None:
+			return None
+		positions[i] = placed[0] + extrude, placed[1] + extrude
+	return max(sheet.height - padding, 0), positions
+
+def pack(sizes, width=0, padding=0, extrude=0, power_of_two=True):
+	"""Pack (w, h) sizes into the smallest sheet, see pack_width.
+
+	With width 0 a few sheet widths around the square root of the total area
+	are tried and the smallest sheet kept.  power_of_two rounds the sheet's
+	sides up to powers of two, the way GPUs like their textures.  Returns
+	((width, height), positions)."""
+	if not sizes:
+		return (0, 0), []
+	grow = 2 * extrude + padding
+	widest = max(w for w, h in sizes) + 2 * extrude
+	if width:
+		candidates = [width]
+	else:
+		area = sum((w + grow) * (h + grow) for w, h in sizes)
+		side = max(widest, int(area ** 0.5))
+		if power_of_two:
+			side = next_power_of_two(side)
+			candidates = [side // 2, side, side * 2]
+		else:
+			candidates = [side, side * 5 // 4, side * 3 // 2]
+		candidates = [c for c in candidates if c >= widest]
+
+	best = None
+	for candidate in candidates:
+		packed = pack_width(sizes, candidate, padding, extrude)
+		if packed is None:
+			continue
+		height, positions = packed
+		if power_of_two:
+			size = next_power_of_two(candidate), next_power_of_two(height)
+		else:
+			size = candidate, height
+		# Smallest area first, then the squarest.
+		key = size[0] * size[1], abs(size[0] - size[1])
+		if best is None or key < best[0]:
+			best = key, size, positions
+	if best is None:
+		raise ValueError("a %dpx wide rectangle can't fit a %dpx wide sheet" % (widest, width))
+	return best[1], best[2]
+
+def extrude_edges(sheet, box, extrude):
+	"Repeat the outermost pixels of box on sheet outwards extrude pixels."
+	left, top, right, bottom = box
+	w, h = right - left, bottom - top
+	strips = (
+		((left, top, left + 1, bottom), (extrude, h), (left - extrude, top)),
+		((right - 1, top, right, bottom), (extrude, h), (right, top)),
+		((left - extrude, top, right + extrude, top + 1), (w + 2 * extrude, extrude), (left - extrude, top - extrude)),
+		((left - extrude, bottom - 1, right + extrude, bottom), (w + 2 * extrude, extrude), (left - extrude, bottom)),
+	)
+	# Sides first, so the top and bottom strips carry the corners out too.
+	for edge, size, pos in strips:
+		sheet.paste(sheet.crop(edge).resize(size, Image.NEAREST), pos)
+
+def compose_sheet(images, size, positions, extrude=0, mode='RGBA'):
+	"Paste images into a new sheet at the positions pack gave them."
+	sheet = Image.new(mode, size)
+	for img, (x, y) in zip(images, positions):
+		sheet.paste(img, (x, y))
+		if extrude:
+			extrude_edges(sheet, (x, y, x + img.size[0], y + img.size[1]), extrude)
+	return sheet
@@ -1,4 +1,11 @@
+import array
+import base64
+import collections
+import hashlib
+import itertools
+import random
 import re
+import sys
 
 from lxml import etree
 from PIL import Image
@@ -6,14 +13,178 @@ from PIL import Image
 import inkex
 import simplestyle
 
+from tti_datauri import decode_uri, make_data_uri
+
+# Tile bookkeeping is stored on the elements themselves under our own namespace
+# so it survives saving, copying and hand editing in Inkscape.
+inkex.NSS[u'tti'] = u'http://www.codesmelter.org/namespaces/tilesettools'
+if hasattr(etree, 'register_namespace'):
+	etree.register_namespace('tti', inkex.NSS[u'tti'])
+
+def declare_namespace(document):
+	"""Declare the tti namespace once on the root of a document about to be
+	written, lxml otherwise declares it again on every element it tags.
+	lxml before 3.5 can't, and writes the declarations out as they are."""
+	root = document.getroot()
+	try:
+		etree.cleanup_namespaces(root, top_nsmap = {'tti': inkex.NSS[u'tti']},
+				keep_ns_prefixes = [prefix for prefix in root.nsmap if prefix])
+	except TypeError:
+		pass
+
 def rgb2hex(rgb):
 	return "#%02X%02X%02X" % rgb
 
-def decode_uri(uri):
-	"Scrap a URI which suitable to pass to Image.open()"
-	if uri.startswith("file:///"):
-		return urllib.unquote(uri[len("file:///"):])
-	return StringIO(uri[uri.find("base64,") + len("base64,"):].decode('base64'))
+def tile_bytes(data):
+	"Pack a tile's pixels into a string of raw bytes."
+	pixels = list(data)
+	if pixels and isinstance(pixels[0], tuple):
+		pixels = itertools.chain.from_iterable(pixels)
+	return array.array('B', pixels).tostring()
+
+def tile_from_bytes(payload, size):
+	"Unpack raw bytes from tile_bytes back into a tuple of pixels."
+	values = array.array('B', payload).tolist()
+	channels = len(values) // (size ** 2)
+	if channels == 1:
+		return tuple(values)
+	return tuple(zip(*[iter(values)] * channels))
+
+def tile_digest(data):
+	"Content address of a tile, the SHA-1 of its raw pixel bytes."
+	if not isinstance(data, str):
+		data = tile_bytes(data)
+	return hashlib.sha1(data).hexdigest()
+
+# Tilemap cells whose tile isn't on any Tileset Layer.
+NO_TILE = 0xffff
+
+def pack_tilemap(slots):
+	"Pack tile slots into base64 encoded little-endian uint16s."
+	packed = array.array('H', [NO_TILE if slot is None else slot for slot in slots])
+	if sys.byteorder == 'big':
+		packed.byteswap()
+	return base64.b64encode(packed.tostring())
+
+def unpack_tilemap(blob):
+	"Unpack a list of tile slots from pack_tilemap, NO_TILE for none."
+	packed = array.array('H', base64.b64decode(blob))
+	if sys.byteorder == 'big':
+		packed.byteswap()
+	return packed.tolist()
+
+def pack_transforms(transforms):
+	"Pack the DIHEDRAL transform of each tilemap cell into base64 bytes."
+	return base64.b64encode(array.array('B', transforms).tostring())
+
+def set_tilemap(element, slots, columns, origin=(0, 0), tile_size=12,
+		transforms=None):
+	"""Record on a source image which tile slot, row by row, covers each cell
+	of its tile grid, starting at origin. transforms optionally gives the
+	DIHEDRAL transform each cell's tile is drawn with."""
+	if any(slot >= NO_TILE for slot in slots if slot is not None):
+		inkex.errormsg("Tilemaps can only address %d tiles" % NO_TILE)
+		return
+
+	element.set(inkex.addNS('tilemap', 'tti'), pack_tilemap(slots))
+	element.set(inkex.addNS('columns', 'tti'), str(columns))
+	element.set(inkex.addNS('origin', 'tti'), '%d,%d' % tuple(origin))
+	element.set(inkex.addNS('size', 'tti'), str(tile_size))
+	if transforms is not None:
+		element.set(inkex.addNS('transforms', 'tti'), pack_transforms(transforms))
+	elif inkex.addNS('transforms', 'tti') in element.attrib:
+		del element.attrib[inkex.addNS('transforms', 'tti')]
+
+def get_tilemap(element):
+	"""Read a tilemap back from a source image as a list of rows of slots,
+	or None if it doesn't have one."""
+	blob = element.get(inkex.addNS('tilemap', 'tti'))
+	if blob is None:
+		return None
+	slots = unpack_tilemap(blob)
+	columns = int(element.get(inkex.addNS('columns', 'tti')))
+	return [slots[i:i + columns] for i in range(0, len(slots), columns)]
+
+def get_tilemap_transforms(element):
+	"""Read the DIHEDRAL transform of each tilemap cell back as a list of
+	rows, or None if the tilemap has no transforms."""
+	blob = element.get(inkex.addNS('transforms', 'tti'))
+	if blob is None:
+		return None
+	transforms = array.array('B', base64.b64decode(blob)).tolist()
+	columns = int(element.get(inkex.addNS('columns', 'tti')))
+	return [transforms[i:i + columns] for i in range(0, len(transforms), columns)]
+
+def is_rgb(tile):
+	"Are a tile's pixels RGB tuples, rather than grey levels or RGBA?"
+	return bool(tile) and isinstance(tile[0], tuple) and len(tile[0]) == 3
+
+def build_palette(tiles, palette=()):
+	"""Every color used by tiles, a sequence of pixel tuples, after those
+	already in palette, new colors ordered by how many tiles use them. Only
+	RGB tiles count, the others can't be embedded as palette PNGs."""
+	counts = collections.Counter()
+	for tile in tiles:
+		if is_rgb(tile):
+			counts.update(set(tile))
+	known = set(palette)
+	fresh = sorted((color for color in counts if color not in known),
+			key = lambda color: (-counts[color], color))
+	return list(palette) + fresh
+
+def set_palette(element, palette):
+	"Record a tileset's palette on its layer as #RRGGBB colors."
+	element.set(inkex.addNS('palette', 'tti'), ' '.join(rgb2hex(color) for color in palette))
+
+def get_palette(element):
+	"Read a layer's palette back as rgb tuples, empty if it doesn't have one."
+	value = element.get(inkex.addNS('palette', 'tti'), '')
+	return [simplestyle.parseColor(color) for color in value.split()]
+
+def palette_bits(colors):
+	"The smallest PNG bit depth an image of this many colors can be indexed with."
+	for bits in (1, 2, 4):
+		if colors <= 1 << bits:
+			return bits
+	return 8
+
+def palette_image(tile, size, palette_index):
+	"""Rebuild a tile as a P mode Image and the bit depth to save it at, or
+	None if it isn't RGB or has too many colors.
+
+	Only the colors the tile uses go into the image's own palette, in the
+	order of the shared palette, so small tiles still get a small PLTE."""
+	if not is_rgb(tile):
+		return None
+	colors = sorted(set(tile), key = palette_index.__getitem__)
+	if len(colors) > 256:
+		return None
+	local = dict((color, i) for i, color in enumerate(colors))
+	img = Image.new('P', (size, size))
+	img.putpalette(list(itertools.chain.from_iterable(colors)))
+	img.putdata([local[color] for color in tile])
+	return img, palette_bits(len(colors))
+
+# The rotations and reflections of a square tile, counter-clockwise, in the
+# order of dihedral_permutations.
+DIHEDRAL = (
+	'rotate 0', 'rotate 90', 'rotate 180', 'rotate 270',
+	'flip', 'flip rotate 90', 'flip rotate 180', 'flip rotate 270',
+)
+# The transform undoing each DIHEDRAL transform.
+DIHEDRAL_INVERSE = (0, 3, 2, 1, 4, 5, 6, 7)
+
+def dihedral_permutations(size):
+	"""Pixel permutations for each DIHEDRAL transform of a size x size tile,
+	pixel i of the transformed tile is pixel permutation[i] of the original.
+	Flips mirror the tile left to right before rotating it."""
+	grid = [[y * size + x for x in range(size)] for y in range(size)]
+	permutations = []
+	for rows in (grid, [row[::-1] for row in grid]):
+		for _ in range(4):
+			permutations.append(list(itertools.chain.from_iterable(rows)))
+			rows = [list(row) for row in zip(*rows)][::-1]
+	return permutations
 
 def pos2index(size, x, y):
 	return x + (y * size)
@@ -21,6 +192,367 @@ def pos2index(size, x, y):
 def index2pos(size, i, offset=0, scale=1):
 	return ((i % size) * scale) + offset, ((i // size) * scale) + offset
 
+class TileIndex(object):
+	"""Index of the tiles already placed on Tileset Layers, keyed by digest.
+
+	Every tile written to a Tileset Layer is tagged with its digest and grid
+	slot so later scrapes only have to read two attributes per tile to know
+	what is already there and where the next free slot is. Tiles that near
+	duplicates were merged into also list the merged tiles' digests in
+	tti:aliases, so those aren't scraped again either.
+	"""
+	def __init__(self, columns, tile_size):
+		self.columns = int(columns)
+		self.tile_size = tile_size
+		self.digests = {}
+		self.aliases = {}
+		self.slots = set()
+		self.free_slot = 0
+
+	def __contains__(self, digest):
+		return digest in self.digests
+
+	def __len__(self):
+		return len(self.digests)
+
+	def add_layer(self, layer):
+		"Index every tile on a Tileset Layer."
+		for element in layer.iterchildren():
+			digest = element.get(inkex.addNS('digest', 'tti'))
+			slot = element.get(inkex.addNS('slot', 'tti'))
+
+			if digest is None:
+				# Tiles from before the index existed are hashed once and
+				# tagged, raster ones from their pixels and vector ones from
+				# the pixels their rects paint.
+				if element.tag == inkex.addNS('image', 'svg'):
+					identified = self.identify_image(element)
+				elif element.tag == inkex.addNS('g', 'svg') and \
+						element.get(inkex.addNS('groupmode', 'inkscape')) != 'layer':
+					identified = self.identify_group(element)
+				else:
+					identified = None
+				if identified is None:
+					continue
+				digest, slot = identified
+				self.tag(element, digest, slot)
+
+			self.digests[digest] = element
+			if slot is not None:
+				self.slots.add(int(slot))
+			for alias in element.get(inkex.addNS('aliases', 'tti'), '').split():
+				self.aliases[alias] = digest
+
+	def identify_image(self, element):
+		"Find the digest and grid slot of an untagged <image> tile."
+		img = Image.open(decode_uri(inkex.getHref(element)))
+		x = int(round(inkex.unittouu(element.get('x', '0')) / self.tile_size))
+		y = int(round(inkex.unittouu(element.get('y', '0')) / self.tile_size))
+		return tile_digest(img.convert('RGB').getdata()), pos2index(self.columns, x, y)
+
+	def identify_group(self, element):
+		"""Find the digest and grid slot of an untagged vector tile, None if
+		the group paints nothing."""
+		any_img = AnyImage(self.tile_size)
+		any_img.decode(element, 'vector')
+		if not any_img.data:
+			return None
+		x = int(round(any_img.pos[0] / self.tile_size))
+		y = int(round(any_img.pos[1] / self.tile_size))
+		return tile_digest(any_img.data), pos2index(self.columns, x, y)
+
+	def tag(self, element, digest, slot):
+		element.set(inkex.addNS('digest', 'tti'), digest)
+		element.set(inkex.addNS('slot', 'tti'), str(slot))
+
+	def add(self, element, digest, slot):
+		"Tag and index a newly placed tile."
+		self.tag(element, digest, slot)
+		self.digests[digest] = element
+		self.slots.add(slot)
+
+	def add_aliases(self, digest, aliases):
+		"Record the digests of tiles merged into an indexed tile."
+		element = self.digests[digest]
+		listed = element.get(inkex.addNS('aliases', 'tti'), '').split()
+		listed.extend(alias for alias in aliases if alias not in listed)
+		element.set(inkex.addNS('aliases', 'tti'), ' '.join(listed))
+		for alias in aliases:
+			self.aliases[alias] = digest
+
+	def known(self):
+		"Every digest already on a Tileset Layer, the tiles' and their aliases'."
+		return frozenset(self.digests).union(self.aliases)
+
+	def payloads(self, vector_tiles):
+		"""The (digest, payload) of every indexed tile in slot order, its pixels
+		read back out of the document, see tile_bytes. vector_tiles is a
+		VectorTiles to decode vector tiles with."""
+		image = inkex.addNS('image', 'svg')
+		rect = inkex.addNS('rect', 'svg')
+		atlases = {}
+		tiles = []
+		for digest in sorted(self.digests, key = self.slot):
+			element = self.digests[digest]
+			if element.tag == image:
+				img = Image.open(decode_uri(inkex.getHref(element)))
+				if img.size != (self.tile_size, self.tile_size):
+					continue
+				data = img.convert('RGBA' if img.mode == 'RGBA' else 'RGB').getdata()
+			elif element.tag == rect:
+				layer = element.getparent()
+				if layer not in atlases:
+					atlases[layer] = layer_atlas(layer)
+				if atlases[layer] is None:
+					continue
+				x = int(round(inkex.unittouu(element.get('x', '0'))))
+				y = int(round(inkex.unittouu(element.get('y', '0'))))
+				data = atlases[layer].crop((x, y,
+						x + self.tile_size, y + self.tile_size)).getdata()
+			else:
+				decoded = vector_tiles.decode(element)
+				if decoded is None:
+					continue
+				data = decoded[1].data
+			tiles.append((digest, tile_bytes(data)))
+		return tiles
+
+	def slot(self, digest):
+		"The grid slot of an indexed tile, None if it isn't indexed."
+		element = self.digests.get(digest)
+		if element is None:
+			return None
+		slot = element.get(inkex.addNS('slot', 'tti'))
+		if slot is not None:
+			slot = int(slot)
+		return slot
+
+	def next_slot(self):
+		"The first grid slot no indexed tile occupies."
+		while self.free_slot in self.slots:
+			self.free_slot += 1
+		return self.free_slot
+
+class TileSymbols(object):
+	"""The <symbol> definitions of vector tiles in a document, keyed by digest.
+
+	Each distinct tile is vectorized once into <defs> and every placement of
+	it is a lightweight <use>, symbols already in the document are reused.
+	"""
+	def __init__(self, document, tile_size):
+		root = document.getroot()
+		defs = root.find(inkex.addNS('defs', 'svg'))
+		if defs is None:
+			defs = inkex.etree.Element(inkex.addNS('defs', 'svg'))
+			root.insert(0, defs)
+
+		self.defs = defs
+		self.tile_size = tile_size
+		self.symbols = {}
+		for symbol in defs.iterchildren(inkex.addNS('symbol', 'svg')):
+			digest = symbol.get(inkex.addNS('digest', 'tti'))
+			if digest is not None:
+				self.symbols[digest] = symbol
+
+	def __contains__(self, digest):
+		return digest in self.symbols
+
+	def symbol(self, digest, vectorize):
+		"""The symbol of a tile, vectorize is only called to build its group
+		at 0,0 if the tile hasn't been seen yet."""
+		symbol = self.symbols.get(digest)
+		if symbol is None:
+			symbol = inkex.etree.SubElement(self.defs, inkex.addNS('symbol', 'svg'))
+			symbol.set('id', 'tile-%s' % digest)
+			symbol.set(inkex.addNS('digest', 'tti'), digest)
+			symbol.append(vectorize())
+			self.symbols[digest] = symbol
+		return symbol
+
+	def use(self, digest, pos, vectorize=None):
+		"Place a tile's symbol at pos, see symbol."
+		symbol = self.symbol(digest, vectorize)
+		attrs = {
+			'x': str(pos[0]),
+			'y': str(pos[1]),
+			'width': str(self.tile_size),
+			'height': str(self.tile_size),
+		}
+		use = inkex.etree.Element(inkex.addNS('use', 'svg'), attrs)
+		use.set(inkex.addNS('href', 'xlink'), '#' + symbol.get('id'))
+		return use
+
+class VectorTiles(object):
+	"""Reads vector tiles back into pixels: <g> tiles and <use>s of tile
+	symbols, the group of each symbol is only decoded once however often it
+	is used. get_element looks an element up by id, as Effect.getElementById.
+	"""
+	def __init__(self, tile_size, get_element):
+		self.tile_size = tile_size
+		self.get_element = get_element
+		self.symbols = {}
+
+	def decode(self, tile):
+		"""The digest and AnyImage of a vector tile, None if it isn't one or
+		paints nothing. Tiles are re-hashed, they may have been edited since
+		they were tagged."""
+		if tile.tag == inkex.addNS('use', 'svg'):
+			return self.decode_use(tile)
+		if tile.tag != inkex.addNS('g', 'svg') or \
+				tile.get(inkex.addNS('groupmode', 'inkscape')) == 'layer':
+			return None
+
+		any_img = AnyImage(self.tile_size)
+		with inkex.profile.phase('decode'):
+			any_img.decode(tile, 'vector')
+		if not any_img.data:
+			return None
+		return tile_digest(any_img.data), any_img
+
+	def decode_use(self, use):
+		"A <use> of a tile symbol, drawn where the <use> places it."
+		href = use.get(inkex.addNS('href', 'xlink'), '')
+		if href not in self.symbols:
+			self.symbols[href] = None
+			symbol = self.get_element(href[1:]) if href.startswith('#') else None
+			if symbol is not None:
+				group = symbol.find(inkex.addNS('g', 'svg'))
+				if group is not None:
+					self.symbols[href] = self.decode(group)
+
+		decoded = self.symbols[href]
+		if decoded is None:
+			return None
+		digest, symbol_img = decoded
+		any_img = AnyImage(self.tile_size, (
+				inkex.unittouu(use.get('x', '0')),
+				inkex.unittouu(use.get('y', '0'))), symbol_img.data)
+		any_img.transform = use.get('transform', '')
+		return digest, any_img
+
+class TileAtlas(object):
+	"""One PNG holding every tile of a Tileset Layer laid out on its grid.
+
+	The tiles on the layer are <rect>s filled with a pattern of the atlas
+	image in user space. The atlas has the same layout as the layer, so each
+	rect shows its own tile and nothing is needed per tile in <defs>.
+	"""
+	def __init__(self, document, layer, columns, tile_size, make_id):
+		root = document.getroot()
+		defs = root.find(inkex.addNS('defs', 'svg'))
+		if defs is None:
+			defs = inkex.etree.Element(inkex.addNS('defs', 'svg'))
+			root.insert(0, defs)
+
+		self.columns = int(columns)
+		self.tile_size = tile_size
+		self.tiles = []
+
+		self.pattern = None
+		pattern_id = layer.get(inkex.addNS('atlas', 'tti'))
+		for pattern in defs.iterchildren(inkex.addNS('pattern', 'svg')):
+			if pattern_id is not None and pattern.get('id') == pattern_id:
+				self.pattern = pattern
+		if self.pattern is None:
+			self.pattern = inkex.etree.SubElement(defs, inkex.addNS('pattern', 'svg'))
+			self.pattern.set('id', make_id('tileset-atlas'))
+			self.pattern.set('patternUnits', 'userSpaceOnUse')
+			self.pattern.set('x', '0')
+			self.pattern.set('y', '0')
+			layer.set(inkex.addNS('atlas', 'tti'), self.pattern.get('id'))
+
+		self.image = self.pattern.find(inkex.addNS('image', 'svg'))
+		if self.image is None:
+			self.image = inkex.etree.SubElement(self.pattern, inkex.addNS('image', 'svg'))
+			self.image.set('x', '0')
+			self.image.set('y', '0')
+
+	def tile(self, pos, img):
+		"Queue a tile's Image for the atlas and return the <rect> showing it."
+		self.tiles.append(((int(pos[0]), int(pos[1])), img))
+		attrs = {
+			'x': str(pos[0]),
+			'y': str(pos[1]),
+			'width': str(self.tile_size),
+			'height': str(self.tile_size),
+			'style': simplestyle.formatStyle({
+				'fill': 'url(#%s)' % self.pattern.get('id'),
+				'stroke': 'none',
+			}),
+		}
+		return inkex.etree.Element(inkex.addNS('rect', 'svg'), attrs)
+
+	def empty(self):
+		"Is there no tile for the atlas, neither queued nor already in it?"
+		return not self.tiles and inkex.getHref(self.image) is None
+
+	def update(self):
+		"""Paste the queued tiles into the atlas, re-embed it and return it.
+		An empty atlas has no image to embed, see empty."""
+		href = inkex.getHref(self.image)
+		old = None
+		if href is not None:
+			old = Image.open(decode_uri(href)).convert('RGB')
+
+		width = self.columns * self.tile_size
+		height = old.size[1] if old is not None else 0
+		for (x, y), img in self.tiles:
+			height = max(height, y + self.tile_size)
+
+		atlas = Image.new('RGB', (width, height))
+		if old is not None:
+			atlas.paste(old, (0, 0))
+		for pos, img in self.tiles:
+			atlas.paste(img, pos)
+		self.tiles = []
+
+		self.image.set(inkex.addNS('href', 'xlink'), make_data_uri(atlas))
+		for element in (self.pattern, self.image):
+			element.set('width', str(width))
+			element.set('height', str(height))
+		return atlas
+
+	def tile_rects(self, layer):
+		"""The atlas rect of every tile on layer shown through the atlas, as
+		dicts sorted by slot, for exporting the atlas to other tools."""
+		fill = 'url(#%s)' % self.pattern.get('id')
+		rects = []
+		for element in layer.iterchildren(inkex.addNS('rect', 'svg')):
+			digest = element.get(inkex.addNS('digest', 'tti'))
+			slot = element.get(inkex.addNS('slot', 'tti'))
+			style = simplestyle.parseStyle(element.get('style'))
+			if digest is None or slot is None or style.get('fill') != fill:
+				continue
+			x, y = index2pos(self.columns, int(slot), scale=self.tile_size)
+			rects.append({
+				'digest': digest,
+				'slot': int(slot),
+				'x': x,
+				'y': y,
+				'width': self.tile_size,
+				'height': self.tile_size,
+			})
+		rects.sort(key = lambda rect: rect['slot'])
+		return rects
+
+def layer_atlas(layer):
+	"The atlas Image a Tileset Layer's rects are shown through, if it has one."
+	pattern_id = layer.get(inkex.addNS('atlas', 'tti'))
+	if pattern_id is None:
+		return None
+	for pattern in layer.getroottree().iter(inkex.addNS('pattern', 'svg')):
+		if pattern.get('id') == pattern_id:
+			img = pattern.find(inkex.addNS('image', 'svg'))
+			if img is not None:
+				return Image.open(decode_uri(inkex.getHref(img))).convert('RGB')
+	return None
+
+# One rectangle of a path vectorize_with_paths draws, as the template in
+# color_paths writes it: m dx,dy width,0 0,height -width,0 z
+_number = r'([-+]?\d+(?:\.\d*)?)'
+subpath_pattern = re.compile(r'm\s*%s,%s\s+%s,0\s+0,%s\s+[-+]?\d+(?:\.\d*)?,0\s*z'
+		% ((_number,) * 4))
+
 class AnyImage(object):
 	types = 'raster', 'vector'
 	def __init__(self, size, pos=(0,0), data=None):
@@ -47,110 +579,267 @@ class AnyImage(object):
 		return None
 
 	def decode_raster(self, img):
-		img_uri = img.attrib[inkex.addNS('href', 'xlink')]
+		img_uri = inkex.getHref(img)
 		pil_img = Image.open(decode_uri(img_uri))
 
-		self.data = pil_img.getdata()
-		self.transform = img.transform
+		self.data = pil_img.convert('RGB').getdata()
+		self.transform = img.get('transform', '')
 		self.pos = (inkex.unittouu(img.attrib['x']),
 				    inkex.unittouu(img.attrib['y']))
 
 	def decode_vector(self, img):
-		self.data = [None] * (self.size ** 2)
-		self.transform = img.attrib['transform']
-		self.pos = (float('inf'), float('inf'))
+		"""Read back a group built by vectorize or vectorize_with_paths.
+
+		Only the group's own rects and paths are looked at, each once. Their
+		rectangles are collected in document coordinates, then painted into a
+		preallocated pixel list relative to the top left most of them. A group
+		with neither decodes to no pixels."""
+		self.transform = img.get('transform', '')
 
-		pixels = img.xpath('//svg:rect', namespaces=inkex.NSS)
-		paths = img.xpath('//svg:path', namespaces=inkex.NSS)
+		rect_tag = inkex.addNS('rect', 'svg')
+		path_tag = inkex.addNS('path', 'svg')
+		fills = {}
+		rects = []
+		for child in img.iterchildren(rect_tag, path_tag):
+			style = child.get('style', '')
+			rgb = fills.get(style)
+			if rgb is None:
+				fill = simplestyle.parseStyle(style).get('fill', 'black')
+				rgb = fills[style] = simplestyle.parseColor(fill)
+
+			if child.tag == rect_tag:
+				rects.append((rgb,
+						inkex.unittouu(child.get('x', '0')),
+						inkex.unittouu(child.get('y', '0')),
+						inkex.unittouu(child.get('width', '1')),
+						inkex.unittouu(child.get('height', '1'))))
+				continue
+
+			# Each subpath moves relative to the start of the one before.
+			x = y = 0
+			for subpath in subpath_pattern.finditer(child.get('d', '')):
+				dx, dy, width, height = map(float, subpath.groups())
+				x += dx
+				y += dy
+				rects.append((rgb, x, y, width, height))
 
 		# Because svg groups have no set x,y coords we have to decern the
 		# position from the contents which we can then use as an offset when
 		# reconstructing the image.
-		for pixel in pixels + paths:
-			pos = (inkex.unittouu(pixel.attrib['x']),
-				   inkex.unittouu(pixel.attrib['y']))
-			self.pos[0] = self.pos[0] if self.pos[0] < pos[0] else pos[0]
-			self.pos[1] = self.pos[1] if self.pos[1] < pos[1] else pos[1]
-
-		for pixel in pixels:
-			style = simplestyle.parseStyle(pixel.attrib['style'])
-			pos = (inkex.unittouu(pixel.attrib['x']) - self.pos[0],
-				   inkex.unittouu(pixel.attrib['y']) - self.pos[1])
-			index = pos2index(self.size, *pos)
-			self.data[index] = simplestyle.parseColor(style['fill'])
-
-		last_point = (0, 0)
-		for path in paths:
-			for offset in re.findall('m\s(?P<x>-?\d+),(?P<y>-?\d+).*?z'):
-				style = simplestyle.parseStyle(pixel.attrib['style'])
-				pos = (inkex.unittouu(path.attrib['x']) - self.pos[0] + last_point[0],
-					   inkex.unittouu(path.attrib['y']) - self.pos[1] + last_point[1])
-				index = pos2index(self.size, *pos)
-				self.data[index] = simplestyle.parseColor(style['fill'])
-
-				last_point[0] += offset[0]
-				last_point[1] += offset[1]
+		if not rects:
+			self.data = []
+			return
+		self.pos = (min(rect[1] for rect in rects),
+					min(rect[2] for rect in rects))
+
+		size = self.size
+		data = [(0, 0, 0)] * (size ** 2)
+		for rgb, x, y, width, height in rects:
+			left = max(int(round(x - self.pos[0])), 0)
+			top = max(int(round(y - self.pos[1])), 0)
+			right = min(left + int(round(width)), size)
+			bottom = min(top + int(round(height)), size)
+			run = [rgb] * max(right - left, 0)
+			for row in range(top, bottom):
+				data[row * size + left:row * size + right] = run
+		self.data = data
 
 	def rasterize(self):
-		img = Image.new('rgb', (self.size, self.size))
-		img.putdata(self.data)
+		img = Image.new('RGB', (self.size, self.size))
+		img.putdata(list(self.data))
 		return img
 
-	def vectorize(self):
-		tile_group = inkex.etree.Element(inkex.addNS('g', 'svg'))
-		for i, rgb in enumerate(self.data):
-			x, y = index2pos(self.size, i)
-			x += self.pos[0]
-			y += self.pos[1]
+	def rectangles(self):
+		"""Merge the pixels into single colored rectangles, the maximal run of
+		each color along a row stacked with identical runs directly below it.
 
-			style = {
-				'stroke': 'none',
-				'fill': rgb2hex(rgb),
-			}
+		Returns (rgb, x, y, width, height) tuples in tile coordinates, ordered
+		by their top left corner, which together cover every pixel once.
+		"""
+		size = self.size
+		data = list(self.data)
+		rects = []
+		above = {}
+		for y in range(0, size):
+			row = data[y * size:(y + 1) * size]
+			current = {}
+			x = 0
+			while x < size:
+				start, rgb = x, row[x]
+				while x < size and row[x] == rgb:
+					x += 1
 
-			attrs = {
-				'style': simplestyle.formatStyle(style),
-				'x': str(x),
-				'y': str(y),
-				'width': '1',
-				'height': '1',
-			}
+				run = (start, x, rgb)
+				rect = above.get(run)
+				if rect is None:
+					rect = [rgb, start, y, x - start, 0]
+					rects.append(rect)
+				rect[4] += 1
+				current[run] = rect
+			above = current
+		return [tuple(rect) for rect in rects]
 
-			pixel = inkex.etree.Element(inkex.addNS('rect', 'svg'), attrs)
-			tile_group.append(pixel)
-		return tile_group
+	def pixel_rects(self, merge=False):
+		"""The (rgb, x, y, width, height) rectangles making up the tile, one
+		per pixel or merged as in rectangles."""
+		if merge:
+			return self.rectangles()
+		return [(rgb,) + index2pos(self.size, i) + (1, 1)
+				for i, rgb in enumerate(self.data)]
 
-	def vectorize_with_paths(self):
-		tile_group = inkex.etree.Element(inkex.addNS('g', 'svg'))
+	def rect_attrs(self, rgb, x, y, width, height):
+		style = {
+			'stroke': 'none',
+			'fill': rgb2hex(rgb),
+		}
+
+		attrs = {
+			'style': simplestyle.formatStyle(style),
+			'x': str(x + self.pos[0]),
+			'y': str(y + self.pos[1]),
+			'width': str(width),
+			'height': str(height),
+		}
+		return attrs
+
+	def color_paths(self, merge=False):
+		"""The path data drawing each color's rectangles, as (rgb, d) pairs."""
 		color_groups = {}
-		for i, rgb in enumerate(self.data):
-			x, y = index2pos(self.size, i)
+		for rgb, x, y, width, height in self.pixel_rects(merge):
 			x += self.pos[0]
 			y += self.pos[1]
 
 			if rgb not in color_groups:
 				color_groups[rgb] = []
-			color_groups[rgb].append((x, y))
+			color_groups[rgb].append((x, y, width, height))
 
+		paths = []
 		for rgb, points in color_groups.iteritems():
 			path = ""
-			path_template = "m %d,%d 1,0 0,1 -1,0 z "
+			path_template = "m %d,%d %d,0 0,%d %d,0 z "
 			last_point = (0, 0)
 			for point in points:
 				path += path_template % (point[0]-last_point[0],
-										 point[1]-last_point[1])
+										 point[1]-last_point[1],
+										 point[2], point[3], -point[2])
 				last_point = point
+			paths.append((rgb, path))
+		return paths
 
-			style = {
-				'stroke': 'none',
-				'fill': rgb2hex(rgb),
-			}
+	def path_attrs(self, rgb, path):
+		style = {
+			'stroke': 'none',
+			'fill': rgb2hex(rgb),
+		}
 
-			attrs = {
-				'd': path,
-				'style': simplestyle.formatStyle(style),
-			}
+		attrs = {
+			'd': path,
+			'style': simplestyle.formatStyle(style),
+		}
+		return attrs
 
+	def vectorize(self, merge=False):
+		"""Build an svg group with a rect per pixel, or with merge a rect per
+		single colored rectangle of pixels."""
+		tile_group = inkex.etree.Element(inkex.addNS('g', 'svg'))
+		for rect in self.pixel_rects(merge):
+			attrs = self.rect_attrs(*rect)
+			pixel = inkex.etree.Element(inkex.addNS('rect', 'svg'), attrs)
+			tile_group.append(pixel)
+		return tile_group
+
+	def vectorize_with_paths(self, merge=False):
+		"""Build an svg group with a path per color, made of a square subpath
+		per pixel, or with merge a subpath per single colored rectangle."""
+		tile_group = inkex.etree.Element(inkex.addNS('g', 'svg'))
+		for rgb, path in self.color_paths(merge):
+			attrs = self.path_attrs(rgb, path)
 			pixel_group = inkex.etree.Element(inkex.addNS('path', 'svg'), attrs)
 			tile_group.append(pixel_group)
 		return tile_group
+
+	def vectorize_markup(self, merge=False):
+		"""The children of the group vectorize builds as svg markup, without
+		creating an element, style dict or color string per pixel."""
+		template = markup_template('rect', self.rect_attrs((0, 0, 0), 0, 0, 1, 1))
+		styles = {}
+		markup = []
+		for rgb, x, y, width, height in self.pixel_rects(merge):
+			if rgb not in styles:
+				styles[rgb] = self.rect_attrs(rgb, 0, 0, 1, 1)['style']
+			markup.append(template % {
+				'style': styles[rgb],
+				'x': x + self.pos[0],
+				'y': y + self.pos[1],
+				'width': width,
+				'height': height,
+			})
+		return ''.join(markup)
+
+	def vectorize_with_paths_markup(self, merge=False):
+		"The children of the group vectorize_with_paths builds as svg markup."
+		template = markup_template('path', self.path_attrs((0, 0, 0), ''))
+		return ''.join(template % self.path_attrs(rgb, path)
+				for rgb, path in self.color_paths(merge))
+
+_markup_templates = {}
+
+def markup_template(tag, attrs):
+	"""A %-format template serializing an svg element with attrs' keys the
+	way lxml would, attribute order included."""
+	key = (tag, tuple(attrs))
+	if key not in _markup_templates:
+		element = inkex.etree.Element(inkex.addNS(tag, 'svg'), attrs)
+		_markup_templates[key] = '<%s %s/>' % (tag,
+				' '.join('%s="%%(%s)s"' % (name, name) for name in element.keys()))
+	return _markup_templates[key]
+
+class Fragments(object):
+	"""Pre-formatted svg markup for the children of elements, spliced into the
+	output as the document is written.
+
+	Vector tiles are hundreds of elements each, so rather than building them
+	as a tree only to serialize it, attach their markup to an empty element
+	and write the document through write.
+	"""
+	def __init__(self):
+		self.marker = 'tti-fragment-%x-' % random.getrandbits(64)
+		self.markup = []
+
+	def attach(self, element, markup):
+		"Give an element markup as its children, returns the element."
+		element.text = '%s%d;' % (self.marker, len(self.markup))
+		self.markup.append(markup)
+		if inkex.profile.enabled:
+			inkex.profile.count('svg_nodes_created', markup.count('<'))
+		return element
+
+	def expand(self, element):
+		"Turn an element's attached markup into real children."
+		if not element.text or not element.text.startswith(self.marker):
+			return element
+		markup = self.markup[int(element.text[len(self.marker):-1])]
+		element.text = None
+		wrapper = etree.fromstring('<g xmlns="%s">%s</g>' % (inkex.NSS['svg'], markup))
+		element.extend(list(wrapper))
+		return element
+
+	def write(self, document, stream):
+		"Serialize a document to a stream with every fragment spliced in."
+		declare_namespace(document)
+		root = document.getroot()
+		if root.nsmap.get(None) != inkex.NSS['svg']:
+			# The markup assumes svg is the default namespace
+			for element in list(root.iter()):
+				self.expand(element)
+			document.write(stream)
+			return
+
+		data = etree.tostring(document)
+		pattern = re.compile(re.escape(self.marker) + r'(\d+);')
+		last = 0
+		for match in pattern.finditer(data):
+			stream.write(data[last:match.start()])
+			stream.write(self.markup[int(match.group(1))])
+			last = match.end()
+		stream.write(data[last:])
@@ -2,15 +2,13 @@
 import logging
 import itertools
 import sys
-import urllib
-
-from cStringIO import StringIO
 
 import inkex
 import simplestyle
 import tti_tools
 
 from PIL import Image
+from tti_datauri import decode_uri
 
 logging.basicConfig(
 	level=logging.ERROR,
@@ -24,6 +22,8 @@ class VectorizeTiles(inkex.Effect):
 
 	def __init__(self):
 		inkex.Effect.__init__(self)
+		self.lazy_payloads = True
+		self.fragments = tti_tools.Fragments()
 
 		self.OptionParser.add_option('-s', '--size',
 						action = 'store', type = 'int',
@@ -40,16 +40,27 @@ class VectorizeTiles(inkex.Effect):
 						dest = 'group', default = True,
 						help = 'Group like colors into paths?')
 
+		self.OptionParser.add_option('-i', '--instance',
+						action = 'store', type = 'inkbool',
+						dest = 'instance', default = False,
+						help = 'Share repeated tiles through symbols?')
+
+		self.OptionParser.add_option('-e', '--merge',
+						action = 'store', type = 'inkbool',
+						dest = 'merge', default = True,
+						help = 'Merge like colored pixels into rectangles?')
+
 	def effect(self):
 		self.tile_size = tile_size = self.options.tile_size
 		all = self.options.all
 
 		if all:
-			layers = self.document.xpath('//svg:g[@inkscape:label="Tileset Layer"]', namespaces=inkex.NSS)
+			layers = self.getLayersByLabel('Tileset Layer')
 		else:
-			base = self.xpathSingle('//sodipodi:namedview[@id="base"]')
-			current_layer = base.attrib[inkex.addNS('current-layer', 'inkscape')]
-			layers = [self.getElementById(current_layer)]
+			layers = [self.current_layer]
+
+		if self.options.instance:
+			self.symbols = tti_tools.TileSymbols(self.document, tile_size)
 
 		for layer in layers:
 			tiles = layer.xpath('svg:image', namespaces=inkex.NSS)
@@ -58,43 +69,55 @@ class VectorizeTiles(inkex.Effect):
 				layer.remove(tile)
 				layer.append(vector_tile)
 
-		return
-
-
-		tiles = set()
-		for uri in self.gather_source_uris():
-			tiles |= get_unique_tiles(Image.open(self.decode_uri(uri)), tile_size)
-
-		tiles = [rebuild_tile(tile, tile_size) for tile in tiles]
-		for i, tile in enumerate(tiles):
-			uri = make_data_uri(tile)
-			img = self.build_svg_img(
-				uri,
-				x = str((i % columns) * tile_size),
-				y = str((i // columns) * tile_size),
-				width = str(tile_size),
-				height = str(tile_size)
-			)
-			set_layer.append(img)
-
 	def vectorize_tile(self, tile):
 		tile_size = self.tile_size
 		tile_x = inkex.unittouu(tile.attrib['x'])
 		tile_y = inkex.unittouu(tile.attrib['y'])
-		tile_img = Image.open(self.decode_uri(tile.attrib[inkex.addNS('href', 'xlink')]))
-		tile_data = tile_img.getdata()
-
-		any_img = tti_tools.AnyImage(tile_size, (tile_x, tile_y), tile_data)
-
-		if self.options.group:
-			return any_img.vectorize_with_paths()
 
-		return any_img.vectorize()
-
-	def decode_uri(self, uri):
-		if uri.startswith("file:///"):
-			return urllib.unquote(uri[len("file:///"):])
-		return StringIO(uri[uri.find("base64,") + len("base64,"):].decode('base64'))
+		if self.options.instance:
+			vector_tile = self.instance_tile(tile, (tile_x, tile_y))
+		else:
+			tile_data = self.decode_tile(tile)
+			any_img = tti_tools.AnyImage(tile_size, (tile_x, tile_y), tile_data)
+			vector_tile = self.build_vector_tile(any_img)
+
+		# Carry the tile index bookkeeping over to the vectorized tile.
+		for name, value in tile.attrib.iteritems():
+			if name.startswith('{%s}' % inkex.NSS['tti']):
+				vector_tile.set(name, value)
+
+		return vector_tile
+
+	def instance_tile(self, tile, pos):
+		"""Place a <use> of the tile's symbol, only decoding and vectorizing
+		the tile if no symbol has its digest yet."""
+		digest = tile.get(inkex.addNS('digest', 'tti'))
+		if digest is None or digest not in self.symbols:
+			tile_data = self.decode_tile(tile)
+			if digest is None:
+				digest = tti_tools.tile_digest(tile_data)
+			vectorize = lambda: self.build_vector_tile(
+					tti_tools.AnyImage(self.tile_size, (0, 0), tile_data))
+		else:
+			vectorize = None
+		return self.symbols.use(digest, pos, vectorize)
+
+	def decode_tile(self, tile):
+		with inkex.profile.phase('decode'):
+			tile_img = Image.open(decode_uri(inkex.getHref(tile)))
+			return tile_img.convert('RGB').getdata()
+
+	def output(self):
+		self.fragments.write(self.document, sys.stdout)
+
+	def build_vector_tile(self, any_img):
+		tile_group = inkex.etree.Element(inkex.addNS('g', 'svg'))
+		with inkex.profile.phase('vectorize'):
+			if self.options.group:
+				markup = any_img.vectorize_with_paths_markup(self.options.merge)
+			else:
+				markup = any_img.vectorize_markup(self.options.merge)
+		return self.fragments.attach(tile_group, markup)
 
 	def build_svg_img(self, uri, **attrs):
 		img = inkex.etree.Element(inkex.addNS('image', 'svg'), attrs)